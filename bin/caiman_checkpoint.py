@@ -0,0 +1,175 @@
+# import
+## batteries
+import os
+import json
+import shutil
+import hashlib
+import logging
+## 3rd party
+import numpy as np
+
+# Bump if the checkpoint format changes
+CHECKPOINT_VERSION = 1
+# Checkpoint file of each stage of caiman_run.py, in order
+CHECKPOINT_STAGES = {
+    'memmap': 'memmap.json',     # the (cropped) memmap file of the movie
+    'cn_pnr': 'cn_pnr.npz',      # the correlation and peak-to-noise ratio images
+    'fit': 'cnm_fit.hdf5',       # the fitted CNMF
+    'eval': 'cnm_eval.hdf5',     # the evaluated CNMF estimates
+}
+# Size of the blocks of the input file that are hashed
+HASH_BLOCK_SIZE = 4 << 20
+
+
+# functions
+def input_hash(fname: str, block_size: int=HASH_BLOCK_SIZE) -> str:
+    """
+    Hashes an input file by its size and its first, middle, and last blocks,
+    which identifies a movie without reading all of it.
+    Args:
+        fname: The file path.
+        block_size: The size of the hashed blocks.
+    Returns:
+        The sha256 hex digest.
+    """
+    h = hashlib.sha256()
+    size = os.path.getsize(fname)
+    h.update(str(size).encode())
+    with open(fname, "rb") as inF:
+        for offset in sorted({0, max(size // 2 - block_size // 2, 0), max(size - block_size, 0)}):
+            inF.seek(offset)
+            h.update(inF.read(block_size))
+    return h.hexdigest()
+
+
+# classes
+class Checkpoints:
+    """
+    Checkpoints of the stages of caiman_run.py, so that a retried or resumed run starts at the first incomplete stage.
+
+    The checkpoints of a run are kept in `<root>/<key>/`, where the key hashes the input files and the parameters,
+    so checkpoints are only reused for the same inputs and parameters. Each checkpoint file is written
+    to a temporary file and renamed, so a checkpoint exists only if its stage completed.
+    If `root` is None, checkpointing is disabled (nothing is saved and no checkpoint exists).
+
+    Attributes:
+        dir: The checkpoint directory of the run (None if disabled).
+    """
+    def __init__(self, root: str, input_files: list, params: dict):
+        """
+        Args:
+            root: The checkpoint root directory, or None to disable checkpointing.
+            input_files: The input files of the run (None entries are skipped).
+            params: The parameters of the run that affect the results.
+        """
+        self.dir = None
+        if root is None:
+            return
+        h = hashlib.sha256()
+        h.update(json.dumps({'version': CHECKPOINT_VERSION, 'params': params}, sort_keys=True).encode())
+        for fname in input_files:
+            if fname is not None:
+                h.update(input_hash(fname).encode())
+        self.dir = os.path.join(os.path.abspath(root), h.hexdigest()[:32])
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, "params.json"), "w") as outF:
+            json.dump(params, outF, indent=2, sort_keys=True)
+        done = [stage for stage in CHECKPOINT_STAGES if self.has(stage)]
+        logging.info(f"Checkpoint directory: {self.dir} (completed stages: {', '.join(done) or 'none'})")
+
+    def path(self, stage: str) -> str:
+        """
+        Gets the checkpoint file of a stage.
+        Args:
+            stage: The stage name (see CHECKPOINT_STAGES).
+        Returns:
+            The checkpoint file path (None if disabled).
+        """
+        if self.dir is None:
+            return None
+        return os.path.join(self.dir, CHECKPOINT_STAGES[stage])
+
+    def has(self, stage: str) -> bool:
+        """
+        Checks whether a stage has a checkpoint.
+        Args:
+            stage: The stage name.
+        Returns:
+            True if the stage completed in a previous run.
+        """
+        return self.dir is not None and os.path.isfile(self.path(stage))
+
+    def save(self, stage: str, write_func) -> None:
+        """
+        Saves the checkpoint of a stage atomically.
+        Args:
+            stage: The stage name.
+            write_func: A function writing the checkpoint to the (temporary) file path it is given.
+        """
+        if self.dir is None:
+            return
+        outfile = self.path(stage)
+        base, ext = os.path.splitext(outfile)
+        tmp_file = f"{base}.tmp{os.getpid()}{ext}"
+        try:
+            write_func(tmp_file)
+            os.replace(tmp_file, outfile)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        logging.info(f"Checkpoint saved: {outfile}")
+
+    def save_json(self, stage: str, data: dict) -> None:
+        """
+        Saves a json checkpoint.
+        Args:
+            stage: The stage name.
+            data: The json-serializable data.
+        """
+        def write(outfile):
+            with open(outfile, "w") as outF:
+                json.dump(data, outF)
+        self.save(stage, write)
+
+    def load_json(self, stage: str) -> dict:
+        """
+        Loads a json checkpoint.
+        Args:
+            stage: The stage name.
+        Returns:
+            The data, or None if there is no checkpoint.
+        """
+        if not self.has(stage):
+            return None
+        with open(self.path(stage)) as inF:
+            return json.load(inF)
+
+    def save_arrays(self, stage: str, **arrays) -> None:
+        """
+        Saves a numpy (npz) checkpoint.
+        Args:
+            stage: The stage name.
+            arrays: The named arrays.
+        """
+        self.save(stage, lambda outfile: np.savez(outfile, **arrays))
+
+    def load_arrays(self, stage: str) -> dict:
+        """
+        Loads a numpy (npz) checkpoint.
+        Args:
+            stage: The stage name.
+        Returns:
+            The named arrays, or None if there is no checkpoint.
+        """
+        if not self.has(stage):
+            return None
+        with np.load(self.path(stage)) as data:
+            return {k: data[k] for k in data.files}
+
+    def clear(self) -> None:
+        """
+        Removes the checkpoints of the run, once it has completed.
+        """
+        if self.dir is not None and os.path.isdir(self.dir):
+            shutil.rmtree(self.dir)
+            logging.info(f"Removed the checkpoint directory: {self.dir}")
@@ -0,0 +1,237 @@
+# import
+## batteries
+import os
+import re
+import threading
+## 3rd party
+import psutil
+import tifffile
+
+# Bytes per value of the CaImAn memmap (float32)
+BYTES_PER_VALUE = 4
+# Memory of the main process besides the movie (imports, CNMF estimates)
+MAIN_BASE = 1 << 30
+# Memory of each worker process besides its patch (imports, buffers)
+WORKER_BASE = 400 << 20
+# Peak memory of the main process per byte of the movie (the full-frame background and residual updates;
+# the memmapped movie pages are file-backed, so they are not counted)
+MOVIE_FACTOR = 0.5
+# Peak memory of the correlation and peak-to-noise ratio images per byte of the movie or tile in memory
+# (the movie or tile, and its filtered copies)
+CN_PNR_FACTOR = 3.0
+# Peak memory of a worker per byte of its patch at full resolution (the patch, and its residual)
+PATCH_FACTOR = 2.0
+# Peak memory of a worker per byte of its subsampled patch (the filtered data, correlation, and peak-to-noise ratio of the initialization)
+PATCH_INIT_FACTOR = 6.0
+# Fraction of the available memory that the predicted peak may use
+MEMORY_SAFETY = 0.8
+# cgroup memory limit files (v2, v1)
+CGROUP_LIMIT_FILES = ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+# CaImAn memmap file name, which encodes the movie shape
+MEMMAP_SHAPE = re.compile(r"_d1_(\d+)_d2_(\d+)_d3_\d+_order_[CF]_frames_(\d+)_\.mmap$")
+
+
+# functions
+def format_bytes(n: float) -> str:
+    """
+    Formats a number of bytes in GB.
+    Args:
+        n: The number of bytes.
+    Returns:
+        The formatted size.
+    """
+    return f"{n / (1 << 30):.1f} GB"
+
+def cnmf_stride(gSig: int) -> int:
+    """
+    Gets the overlap between the CNMF patches: the neuron diameter (4*gSig+1) plus 5 pixels.
+    Args:
+        gSig: The gaussian width of the neuron kernel.
+    Returns:
+        The overlap (pixels).
+    """
+    return 4 * gSig + 1 + 5
+
+def movie_shape(img_file: str) -> tuple:
+    """
+    Gets the shape of a movie without reading it, from the CaImAn memmap file name or the tiff metadata.
+    Args:
+        img_file: The image file, or CaImAn memmap file.
+    Returns:
+        The (d1, d2) frame dimensions and the number of frames.
+    """
+    m = MEMMAP_SHAPE.search(img_file)
+    if m is not None:
+        d1, d2, T = (int(x) for x in m.groups())
+        return (d1, d2), T
+    with tifffile.TiffFile(img_file) as tif:
+        shape = tif.series[0].shape
+    T = 1
+    for n in shape[:-2]:
+        T *= n
+    return tuple(shape[-2:]), T
+
+def available_memory(limit: float=None) -> int:
+    """
+    Gets the memory available to the run: the least of the cgroup memory limit (e.g., of a container or batch job),
+    the memory available on the host, and the given limit.
+    Args:
+        limit: An upper limit (bytes), e.g., the memory requested by the task, or None.
+    Returns:
+        The available memory (bytes).
+    """
+    limits = [psutil.virtual_memory().available]
+    for infile in CGROUP_LIMIT_FILES:
+        try:
+            with open(infile) as inF:
+                value = inF.read().strip()
+            if value != "max":
+                limits.append(int(value))
+        except (OSError, ValueError):
+            pass
+    if limit is not None:
+        limits.append(int(limit))
+    return min(limits)
+
+def patch_count(dims: tuple, rf: int, stride: int) -> int:
+    """
+    Gets the (approximate) number of CNMF patches: patches of 2*rf+1 pixels, overlapping by `stride` pixels.
+    Args:
+        dims: The (d1, d2) frame dimensions.
+        rf: The half-size of the patches.
+        stride: The overlap between the patches.
+    Returns:
+        The number of patches.
+    """
+    step = max(2 * rf + 1 - stride, 1)
+    n = 1
+    for d in dims:
+        n *= max(-(-(d - (2 * rf + 1)) // step), 0) + 1
+    return n
+
+def predict_peak_memory(dims: tuple, T: int, rf: int, stride: int, ssub: int, tsub: int, n_processes: int) -> int:
+    """
+    Predicts the peak memory of CaImAn on a movie: the larger of the correlation/peak-to-noise ratio images stage,
+    and the CNMF stage, in which each busy worker initializes one patch, at full resolution and subsampled
+    by `ssub` (in space) and `tsub` (in time).
+    Args:
+        dims: The (d1, d2) frame dimensions.
+        T: The number of frames.
+        rf: The half-size of the CNMF patches.
+        stride: The overlap between the CNMF patches.
+        ssub: The spatial subsampling factor.
+        tsub: The temporal subsampling factor.
+        n_processes: The number of worker processes.
+    Returns:
+        The predicted peak memory (bytes), summed over the main and worker processes.
+    """
+    movie_bytes = dims[0] * dims[1] * T * BYTES_PER_VALUE
+    patch_bytes = min(2 * rf + 1, dims[0]) * min(2 * rf + 1, dims[1]) * T * BYTES_PER_VALUE
+    worker_bytes = WORKER_BASE + patch_bytes * (PATCH_FACTOR + PATCH_INIT_FACTOR / (ssub ** 2 * tsub))
+    busy = min(n_processes, patch_count(dims, rf, stride))
+    # in parallel, the movie is split into ~2 tiles per process (see `parallel_correlation_pnr`), so ~half is in memory at once
+    cn_pnr_bytes = movie_bytes if n_processes == 1 else movie_bytes / 2
+    cn_pnr = MAIN_BASE + n_processes * WORKER_BASE + CN_PNR_FACTOR * cn_pnr_bytes
+    cnmf = MAIN_BASE + MOVIE_FACTOR * movie_bytes + busy * worker_bytes + (n_processes - busy) * WORKER_BASE
+    return int(max(cn_pnr, cnmf))
+
+def plan_processes(dims: tuple, T: int, rf: int, stride: int, ssub: int, tsub: int,
+                   max_processes: int, available: int) -> int:
+    """
+    Gets the largest number of worker processes whose predicted peak memory fits in the available memory.
+    Args:
+        dims: The (d1, d2) frame dimensions.
+        T: The number of frames.
+        rf: The half-size of the CNMF patches.
+        stride: The overlap between the CNMF patches.
+        ssub: The spatial subsampling factor.
+        tsub: The temporal subsampling factor.
+        max_processes: The max number of processes (e.g., the cpus of the task).
+        available: The available memory (bytes).
+    Returns:
+        The number of processes; if none fits, the number with the smallest predicted peak memory.
+    """
+    budget = MEMORY_SAFETY * available
+    peaks = {n: predict_peak_memory(dims, T, rf, stride, ssub, tsub, n) for n in range(1, max(max_processes, 1) + 1)}
+    fits = [n for n, peak in peaks.items() if peak <= budget]
+    if fits:
+        return max(fits)
+    return min(peaks, key=peaks.get)
+
+def plan_patch_size(dims: tuple, T: int, rf: int, stride: int, ssub: int, tsub: int,
+                    n_processes: int, available: int) -> int:
+    """
+    Gets the largest CNMF patch half-size (up to `rf`) whose predicted peak memory fits in the available memory.
+    The half-size is not shrunk below the patch overlap (`stride`), so that the patches still step by at least
+    the overlap; if even that does not fit, the smallest half-size is returned.
+    Args:
+        dims: The (d1, d2) frame dimensions.
+        T: The number of frames.
+        rf: The requested half-size of the CNMF patches.
+        stride: The overlap between the CNMF patches.
+        ssub: The spatial subsampling factor.
+        tsub: The temporal subsampling factor.
+        n_processes: The number of worker processes.
+        available: The available memory (bytes).
+    Returns:
+        The patch half-size.
+    """
+    budget = MEMORY_SAFETY * available
+    rf_min = min(rf, stride)
+    while rf > rf_min and predict_peak_memory(dims, T, rf, stride, ssub, tsub, n_processes) > budget:
+        rf = max(rf - max(rf // 10, 1), rf_min)
+    return rf
+
+
+# classes
+class PeakRSS:
+    """
+    Measures the peak resident memory of this process and its child processes (e.g., the worker pool),
+    by sampling their summed RSS in a background thread. Memory shared between the processes
+    (e.g., pages of the memmapped movie) is counted in each of them.
+
+    Attributes:
+        peak: The peak summed RSS (bytes) since the measurement started.
+    """
+    def __init__(self, interval: float=0.5):
+        """
+        Args:
+            interval: The sampling interval (seconds).
+        """
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self) -> int:
+        """
+        Samples the summed RSS, and updates the peak.
+        Returns:
+            The summed RSS (bytes).
+        """
+        proc = psutil.Process(os.getpid())
+        rss = proc.memory_info().rss
+        for child in proc.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+        return rss
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self) -> 'PeakRSS':
+        self.peak = 0
+        self.sample()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.sample()
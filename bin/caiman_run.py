@@ -3,12 +3,15 @@
 ## batteries
 from __future__ import print_function
 import os
+import re
+import sys
 import logging
 import argparse
 import warnings
 import xml.etree.ElementTree as ET
 ## 3rd party
 import numpy as np
+import scipy.sparse
 import matplotlib.pyplot as plt
 import tifffile
 import caiman as cm
@@ -17,7 +20,14 @@ from caiman.source_extraction import cnmf
 from caiman.utils.visualization import inspect_correlation_pnr, nb_inspect_correlation_pnr
 from caiman.utils.visualization import plot_contours, nb_view_patches, nb_plot_contour
 # source 
-from load_tiff import load_tiff_metadata, get_metadata_value, extract_exposure
+from image_source import ImageSource, write_caiman_memmap
+from region_stats import read_region_stats, objects_bbox
+from caiman_checkpoint import Checkpoints
+from caiman_tiles import parallel_correlation_pnr
+from caiman_memory import (
+    movie_shape, available_memory, cnmf_stride, predict_peak_memory, plan_processes, plan_patch_size,
+    format_bytes, PeakRSS, MEMORY_SAFETY
+)
 from caiman_plot_traces import plot_traces #plot_original_traces, plot_denoised_traces
 
 
@@ -31,14 +41,17 @@ class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
 
 desc = "Run Caiman on image"
 epi = """DESCRIPTION:
-Run Caiman on a single image file. 
+Run Caiman on one or more image files (wells).
+The images are processed sequentially on one worker pool, which is set up once.
+Each image is given as a frame rate file and image file pair:
+  caiman_run.py well1_frate.txt well1.tif well2_frate.txt well2.tif ...
+With multiple images (or --per_image_dirs), the outputs and the log of each image
+are written to <output_dir>/<image basename>/.
 """
 parser = argparse.ArgumentParser(description=desc, epilog=epi,
                                  formatter_class=CustomFormatter)
-parser.add_argument('frate_file', type=str,
-                    help='File containing the frame rate')
-parser.add_argument('img_file', type=str,
-                    help='Directory path containing the image files')
+parser.add_argument('inputs', type=str, nargs='+',
+                    help='Pairs of a file containing the frame rate and an image file (tiff), or a CaImAn memmap file (*_d1_*_d2_*_d3_1_order_C_frames_*_.mmap) written by mask.py')
 parser.add_argument('--output_dir', type=str, default="caiman_output",
                     help='Output directory')
 parser.add_argument('--decay_time', type=float, default=0.5,
@@ -64,10 +77,48 @@ parser.add_argument('--ring_size_factor', type=float, default=1.4,
 parser.add_argument('--motion_correct', action='store_true', default=False,
                     help = 'Perform motion correction')
 parser.add_argument('-p', '--processes', type=int, default=1,
-                    help='Number of processes to use')
-
+                    help='Max number of processes to use; fewer are used if the predicted peak memory does not fit in the available memory')
+parser.add_argument('--memory_limit', type=float, default=None,
+                    help='Memory available to the run (GB). If not provided, the cgroup memory limit or the available host memory')
+parser.add_argument('--objects_file', type=str, nargs='+', default=None,
+                    help='Mask object statistics (*_mask-objects.csv from mask.py), one per image, in the same order. If provided, CNMF is run on the bounding box of the objects, and the outputs are re-embedded in the full frame')
+parser.add_argument('--checkpoint_dir', type=str, default=None,
+                    help='Checkpoint each stage (memmap, correlation/PNR images, fitted and evaluated CNMF) to this directory, so a retried run starts at the first incomplete stage. Checkpoints are keyed by the inputs and parameters, and removed once the run completes')
+parser.add_argument('--crop_margin', type=int, default=None,
+                    help='Margin around the objects bounding box (pixels). If not provided, the neuron diameter (4*gSig+1)')
+parser.add_argument('--per_image_dirs', action='store_true', default=False,
+                    help='Write the outputs and the log of each image to <output_dir>/<image basename>/, even for a single image')
+
+
+# CaImAn memmap file name suffix, which encodes the layout of the data
+MEMMAP_SUFFIX = re.compile(r"_d1_\d+_d2_\d+_d3_\d+_order_[CF]_frames_\d+_$")
+# CaImAn worker pool (see `setup_cluster`)
+cluster = None
 
 # functions
+def get_base_fname(img_file: str) -> str:
+    """
+    Get the base name of the image file, without the extension or any CaImAn memmap suffix.
+    Args:
+        img_file: The image file path
+    Returns:
+        base_fname: The base name of the image file
+    """
+    return MEMMAP_SUFFIX.sub("", os.path.basename(os.path.splitext(img_file)[0]))
+
+def remove_memmap(fname: str) -> None:
+    """
+    Remove a memmap file created by this run. Input memmap files (written by mask.py --caiman-memmap) are
+    never removed: the staged input is the output of the MASK task, which a retried CAIMAN task, or a CAIMAN task
+    of a `-resume` run (which reuses the cached MASK outputs), stages and reads again.
+    It is removed with the MASK work directory (e.g., by `nextflow clean`).
+    Args:
+        fname: The memmap file path
+    """
+    if os.path.lexists(fname):
+        os.remove(fname)
+    logging.info(f"Removed memory-mapped file: {fname}")
+
 def setup_cluster(processes: int=1) -> int:
     """
     Sets up a new cluster for parallel processing using the CaImAn library.
@@ -80,9 +131,7 @@ def setup_cluster(processes: int=1) -> int:
     Returns:
         n_processes: The number of processes successfully initialized in the new cluster.
     """
-    # Initialize the global cluster variable
     global cluster
-    cluster = None
 
     # Stop the existing cluster if it exists
     if cluster is not None:
@@ -226,7 +275,7 @@ def run_caiman(im, frate: float, decay_time: float, gSig: int, rf: int,
     K = None                     # upper bound on number of components per patch, in general None
     Ain = None                   # possibility to seed with predetermined binary masks
     gSiz = 4 * gSig + 1          # average diameter of a neuron, in general 4*gSig+1
-    stride_cnmf = gSiz + 5       # overlap between patches (pixels) keep >gSiz
+    stride_cnmf = cnmf_stride(gSig)  # overlap between patches (pixels) keep >gSiz
     merge_thresh = 0.7           # merging threshold, max correlation allowed
     low_rank_background = None   # None leaves background of each patch intact
     gnb = -1                     # number of background components (rank) if positive,
@@ -269,7 +318,7 @@ def run_caiman(im, frate: float, decay_time: float, gSig: int, rf: int,
     cnm.params.set("quality", {"min_SNR": min_SNR, "rval_thr": r_values_min, "use_cnn": False})
     return cnm
 
-def cnm_eval_estimates(cnm, Y, frate: float, base_fname: str, output_dir: str) -> None:
+def cnm_eval_estimates(cnm, Y, frate: float, base_fname: str, output_dir: str, evaluate: bool=True, dview=None) -> None:
     """
     Evaluate the CNMF estimates and save the results to the specified output directory.
     Args:
@@ -278,13 +327,17 @@ def cnm_eval_estimates(cnm, Y, frate: float, base_fname: str, output_dir: str) -
         frate: The imaging rate in frames per second
         base_fname: The base filename of the input image
         output_dir: The output directory to save the CNMF output
+        evaluate: If False, the estimates are already evaluated (e.g., loaded from a checkpoint)
+        dview: The worker pool, to evaluate the components in parallel (None = serial)
     """
-    logging.info("Evaluating CNMF estimates...")
-
     # Evaluate the components
-    logging.disable(logging.WARNING)
-    cnm.estimates.evaluate_components(Y, cnm.params)
-    logging.disable(logging.NOTSET)
+    if evaluate:
+        logging.info("Evaluating CNMF estimates...")
+        logging.disable(logging.WARNING)
+        cnm.estimates.evaluate_components(Y, cnm.params, dview=dview)
+        logging.disable(logging.NOTSET)
+    else:
+        logging.info("Using the evaluated CNMF estimates from the checkpoint")
     logging.info(f"Number of total components: {len(cnm.estimates.C)}")
     logging.info(f"Number of accepted components: {len(cnm.estimates.idx_components)}")
 
@@ -309,7 +362,53 @@ def cnm_eval_estimates(cnm, Y, frate: float, base_fname: str, output_dir: str) -
     else:
         logging.warning("No components found to plot traces")
 
-def save_caiman_output(cnm, cn_filter, pnr, base_fname: str, output_dir: str) -> None:
+def crop_memmap(Y: np.ndarray, out_dir: str, crop: tuple, frate: float) -> str:
+    """
+    Writes the cropped movie to a new CaImAn memmap file.
+    Args:
+        Y: The (T, Y, X) image data
+        out_dir: The output directory of the memmap file
+        crop: The (y0, x0, y1, x1) crop box
+        frate: The frame rate
+    Returns:
+        The cropped memmap file path
+    """
+    y0, x0, y1, x1 = crop
+    base = os.path.join(out_dir, "memmap_crop")
+    return write_caiman_memmap(ImageSource.from_array(Y[:, y0:y1, x0:x1], frate), base)
+
+def uncrop_footprints(A, crop: tuple, dims: tuple):
+    """
+    Re-embeds the spatial footprints of a cropped movie in the full frame.
+    Args:
+        A: The sparse (d1c*d2c, K) footprints of the cropped movie (pixels in Fortran order)
+        crop: The (y0, x0, y1, x1) crop box
+        dims: The (d1, d2) full frame dimensions
+    Returns:
+        The sparse (d1*d2, K) footprints
+    """
+    y0, x0, y1, x1 = crop
+    A = scipy.sparse.coo_matrix(A)
+    rows = (A.row % (y1 - y0) + y0) + (A.row // (y1 - y0) + x0) * dims[0]
+    return scipy.sparse.csc_matrix((A.data, (rows, A.col)), shape=(dims[0] * dims[1], A.shape[1]))
+
+def uncrop_image(im: np.ndarray, crop: tuple, dims: tuple) -> np.ndarray:
+    """
+    Re-embeds an image of a cropped movie in the full frame (zero outside of the crop box).
+    Args:
+        im: The (d1c, d2c) image
+        crop: The (y0, x0, y1, x1) crop box
+        dims: The (d1, d2) full frame dimensions
+    Returns:
+        The (d1, d2) image
+    """
+    y0, x0, y1, x1 = crop
+    full = np.zeros(dims, dtype=im.dtype)
+    full[y0:y1, x0:x1] = im
+    return full
+
+def save_caiman_output(cnm, cn_filter, pnr, base_fname: str, output_dir: str, 
+                       crop: tuple=None, dims: tuple=None) -> None:
     """
     Save the output of the CNMF algorithm to the specified output directory.
     Args:
@@ -318,12 +417,21 @@ def save_caiman_output(cnm, cn_filter, pnr, base_fname: str, output_dir: str) ->
         pnr: The peak-to-noise ratio image data
         base_fname: The base filename of the input image
         output_dir: The output directory to save the CNMF output
+        crop: The (y0, x0, y1, x1) crop box, if CNMF was run on a cropped movie
+        dims: The (d1, d2) full frame dimensions, if cropped
     """
     logging.info("Saving CNMF output...")
     logging.disable(logging.WARNING)
 
+    # Re-embed the outputs of a cropped movie in the full frame
+    A = cnm.estimates.A
+    if crop is not None:
+        A = uncrop_footprints(A, crop, dims)
+        cn_filter = uncrop_image(cn_filter, crop, dims)
+        pnr = uncrop_image(pnr, crop, dims)
+
     # Save the spatial footprint of the neurons detected by CNMF
-    np.save(os.path.join(output_dir, f"{base_fname}_cnm-A.npy"), cnm.estimates.A.todense())
+    np.save(os.path.join(output_dir, f"{base_fname}_cnm-A.npy"), A.todense())
             
     # Save the temporal components (i.e., the calcium activity over time) of neurons detected by CNMF
     np.save(os.path.join(output_dir, f"{base_fname}_cnm-C.npy"), cnm.estimates.C)
@@ -359,109 +467,338 @@ def read_frate(infile: str) -> float:
         raise ValueError(f"Could not read frame rate from file {infile}")
     return frate
 
-def main(args):
-    logging.info("Starting caiman_run.py...")
-    # Set max threads (processes) due to memory limitations
-    args.processes = 8 if args.processes > 8 else args.processes
+def checkpoint_params(args, objects_file: str=None) -> dict:
+    """
+    Gets the parameters that affect the results, which key the checkpoints (with the inputs).
+    Args:
+        args: The command line arguments
+        objects_file: The mask object statistics file of the image, if cropping
+    Returns:
+        The parameters
+    """
+    keys = [
+        'decay_time', 'gSig', 'rf', 'min_SNR', 'r_values_min', 'tsub', 'ssub', 
+        'min_corr', 'min_pnr', 'ring_size_factor', 'motion_correct', 'crop_margin'
+    ]
+    params = {k: getattr(args, k) for k in keys}
+    params['objects_file'] = objects_file is not None
+    return params
+
+def prepare_memmap(img_file: str, objects_file: str, args, frate: float, ckpt: Checkpoints) -> dict:
+    """
+    Creates (or reuses) the CaImAn memmap file of the input image, checks it for NaN values,
+    and crops it to the masked objects, if requested.
+    Args:
+        img_file: The image file, or CaImAn memmap file
+        objects_file: The mask object statistics file to crop to (None to use the full frame)
+        args: The command line arguments
+        frate: The frame rate
+        ckpt: The checkpoints of the run; the memmap file is written to the checkpoint directory, if any
+    Returns:
+        The memmap file ('fname'), the crop box ('crop'; None if not cropped), and the full frame dimensions ('dims_full'),
+        or None if the data contains NaN values.
+    """
+    # Reuse the memmap file of a previous attempt
+    input_fname = os.path.abspath(img_file)
+    mm = ckpt.load_json('memmap')
+    if mm is not None:
+        if mm['is_input']:
+            # the input memmap file is used as is (its path may differ between attempts)
+            mm['fname'] = input_fname
+        if os.path.isfile(mm['fname']):
+            logging.info(f"Using the memory-mapped file from the checkpoint: {mm['fname']}")
+            return mm
+
+    # Create a memory-mapped file using CaImAn from the temp file, unless the input already is one
+    if img_file.endswith(".mmap"):
+        logging.info("Using the input memory-mapped file...")
+        fname_new = input_fname
+    else:
+        logging.info("Creating memory-mapped file...")
+        base_name = "memmap_" if ckpt.dir is None else os.path.join(ckpt.dir, "memmap_")
+        fname_new = cm.save_memmap([img_file], base_name=base_name, order="C")
 
+    try:
+        # Load the memory-mapped file
+        Yr, dims, T = cm.load_memmap(fname_new)
+        Y = Yr.T.reshape((T,) + dims, order="F")
+        src = ImageSource.from_array(Y, frate)
+        if any(np.isnan(chunk).any() for _, chunk in src.iter_chunks()):
+            logging.error("NaN values found in the memory mapped data!")
+            logging.error(f"Exiting early to prevent later failure in file {img_file}")
+            if fname_new != input_fname:
+                remove_memmap(fname_new)
+            return None
+        else:
+            logging.info("Memory mapped data appears clean.")
+
+        # Crop the movie to the bounding box of the masked objects
+        crop, dims_full = None, dims
+        if objects_file is not None:
+            margin = args.crop_margin if args.crop_margin is not None else 4 * args.gSig + 1
+            crop = objects_bbox(read_region_stats(objects_file), dims, margin)
+            if crop is None or crop == (0, 0) + tuple(dims):
+                logging.info("No masked objects to crop to; using the full frame")
+                crop = None
+            else:
+                logging.info(f"Cropping the movie to the masked objects (y0, x0, y1, x1): {crop}")
+                fname_crop = crop_memmap(Y, ckpt.dir or os.path.dirname(fname_new), crop, frate)
+                del Y, Yr, src
+                # only the memmap file created by this run is removed (not the input)
+                if fname_new != input_fname:
+                    remove_memmap(fname_new)
+                fname_new = fname_crop
+    except BaseException:
+        # the memmap file created by this run is not checkpointed yet, so it is removed
+        if fname_new != input_fname and os.path.lexists(fname_new):
+            remove_memmap(fname_new)
+        raise
+
+    # Checkpoint
+    mm = {
+        'fname': fname_new, 'is_input': fname_new == input_fname,
+        'crop': list(crop) if crop is not None else None, 'dims_full': list(dims_full)
+    }
+    ckpt.save_json('memmap', mm)
+    return mm
+
+def process_image(frate_file: str, img_file: str, objects_file: str, output_dir: str, args, 
+                  n_processes: int, available: int) -> int:
+    """
+    Runs CaImAn on one image, using the worker pool (see `setup_cluster`), which is kept open.
+    Args:
+        frate_file: The file containing the frame rate
+        img_file: The image file, or CaImAn memmap file
+        objects_file: The mask object statistics file to crop to (None to use the full frame)
+        output_dir: The output directory of the image
+        args: The command line arguments
+        n_processes: The number of processes of the worker pool
+        available: The memory available to the run (bytes)
+    Returns:
+        The predicted peak memory (bytes), or None if CaImAn was not run
+    """
     # Get the frame rate
-    frate = read_frate(args.frate_file)
+    frate = read_frate(frate_file)
     logging.info(f"Frame rate set to: {frate}")
 
-    # Create a memory-mapped file using CaImAn from the temp file
-    logging.info("Creating memory-mapped file...")
-    fname_new = cm.save_memmap([args.img_file], base_name="memmap_", order="C")
-  
-    # Load the memory-mapped file
-    Yr, dims, T = cm.load_memmap(fname_new)
-    Y = Yr.T.reshape((T,) + dims, order="F")
-    if np.any(np.isnan(Y)):
-        logging.error("NaN values found in the memory mapped data!")
-        logging.error(f"Exiting early to prevent later failure in file {args.img_file}")
-        # Create empty output directory to prevent pipeline failure
-        os.makedirs(args.output_dir, exist_ok=True)
-        return
-    else:
-        logging.info("Memory mapped data appears clean.")
-
-    # Set output
-    os.makedirs(args.output_dir, exist_ok=True)
-    base_fname = os.path.basename(os.path.splitext(args.img_file)[0])
+    # Checkpoints of the stages, keyed by the inputs and the parameters
+    ckpt = Checkpoints(args.checkpoint_dir, [img_file, objects_file], checkpoint_params(args, objects_file))
 
-    # Compute correlation and peak-to-noise ratio images
-    logging.info("Computing correlation and peak-to-noise ratio images...")
-    cn_filter, pnr = cm.summary_images.correlation_pnr(Y, gSig=args.gSig, swap_dim=False)
-
-    # Plot the correlation and peak-to-noise ratio images
-    plot_correlations(cn_filter, pnr, base_fname, args.output_dir)
+    # Create (or reuse) the memory-mapped file
+    mm = prepare_memmap(img_file, objects_file, args, frate, ckpt)
+    if mm is None:
+        # Create empty output directory to prevent pipeline failure
+        os.makedirs(output_dir, exist_ok=True)
+        return None
+    fname_new = mm['fname']
+    crop = tuple(mm['crop']) if mm['crop'] is not None else None
+    dims_full = tuple(mm['dims_full'])
 
-    # Run caiman algorithm
-    logging.info("Running Caiman...")
-    logging.disable(logging.CRITICAL)
-    with warnings.catch_warnings(): 
-        # suppress all warnings
-        warnings.filterwarnings("ignore", category=RuntimeWarning)
-        warnings.filterwarnings("ignore", category=UserWarning)
-        # Set the cluster for parallel processing
-        n_processes = setup_cluster(args.processes)
-        # Run Caiman
-        try:
-            cnm = run_caiman(
-                Y, 
-                frate=frate, 
-                decay_time=args.decay_time,
-                gSig=args.gSig,
-                rf=args.rf,
-                min_SNR=args.min_SNR,
-                r_values_min=args.r_values_min,
-                tsub=args.tsub,
-                ssub=args.ssub,
-                min_corr=args.min_corr,
-                min_pnr=args.min_pnr,
-                ring_size_factor=args.ring_size_factor,
-                n_processes=n_processes,
-                motion_correct=args.motion_correct
+    try:
+        # Load the memory-mapped file
+        Yr, dims, T = cm.load_memmap(fname_new)
+        Y = Yr.T.reshape((T,) + dims, order="F")
+
+        # Shrink the CNMF patches, if the predicted peak memory does not fit with the worker pool
+        stride = cnmf_stride(args.gSig)
+        rf = plan_patch_size(dims, T, args.rf, stride, args.ssub, args.tsub, n_processes, available)
+        predicted = predict_peak_memory(dims, T, rf, stride, args.ssub, args.tsub, n_processes)
+        if rf < args.rf:
+            logging.warning(f"Patch half-size (rf) reduced from {args.rf} to {rf} to fit in the available memory")
+        if predicted > MEMORY_SAFETY * available:
+            logging.warning(f"Predicted peak memory ({format_bytes(predicted)}) exceeds {MEMORY_SAFETY:.0%} of the available memory ({format_bytes(available)})")
+        logging.info(f"Predicted peak memory: {format_bytes(predicted)} ({dims[0]}x{dims[1]}x{T} movie, rf={rf}, {n_processes} processes)")
+
+        # Set output
+        os.makedirs(output_dir, exist_ok=True)
+        base_fname = get_base_fname(img_file)
+
+        # Stages completed in a previous attempt
+        evaluated = ckpt.has('eval')
+        fitted = evaluated or ckpt.has('fit')
+        # Compute correlation and peak-to-noise ratio images
+        cn_pnr = ckpt.load_arrays('cn_pnr')
+        if cn_pnr is not None:
+            logging.info("Using the correlation and peak-to-noise ratio images from the checkpoint")
+            cn_filter, pnr = cn_pnr['cn_filter'], cn_pnr['pnr']
+        else:
+            logging.info("Computing correlation and peak-to-noise ratio images...")
+            if cluster is not None and n_processes > 1:
+                cn_filter, pnr = parallel_correlation_pnr(fname_new, args.gSig, cluster, n_processes)
+            else:
+                cn_filter, pnr = cm.summary_images.correlation_pnr(Y, gSig=args.gSig, swap_dim=False)
+            ckpt.save_arrays('cn_pnr', cn_filter=cn_filter, pnr=pnr)
+
+        # Plot the correlation and peak-to-noise ratio images
+        plot_correlations(cn_filter, pnr, base_fname, output_dir)
+
+        # Run caiman algorithm (or load the fitted/evaluated CNMF of a previous attempt)
+        if fitted:
+            stage = 'eval' if evaluated else 'fit'
+            logging.info(f"Loading the CNMF from the checkpoint: {ckpt.path(stage)}")
+            cnm = cnmf.load_CNMF(ckpt.path(stage))
+        else:
+            logging.info("Running Caiman...")
+            logging.disable(logging.CRITICAL)
+            with warnings.catch_warnings(): 
+                # suppress all warnings
+                warnings.filterwarnings("ignore", category=RuntimeWarning)
+                warnings.filterwarnings("ignore", category=UserWarning)
+                # Run Caiman
+                cnm = run_caiman(
+                    Y, 
+                    frate=frate, 
+                    decay_time=args.decay_time,
+                    gSig=args.gSig,
+                    rf=rf,
+                    min_SNR=args.min_SNR,
+                    r_values_min=args.r_values_min,
+                    tsub=args.tsub,
+                    ssub=args.ssub,
+                    min_corr=args.min_corr,
+                    min_pnr=args.min_pnr,
+                    ring_size_factor=args.ring_size_factor,
+                    n_processes=n_processes,
+                    motion_correct=args.motion_correct
+                )
+            # Reset the logger level
+            logging.disable(logging.NOTSET)    
+            ckpt.save('fit', cnm.save)
+
+        # Check if any components were found
+        if cnm.estimates.C.shape[0] == 0:
+            logging.error(f"No components found in file {base_fname}")
+
+        # Save the output  
+        save_caiman_output(cnm, cn_filter, pnr, base_fname, output_dir, crop, dims_full)
+
+        # Set the estimates
+        cnm_eval_estimates(cnm, Y, frate, base_fname, output_dir, evaluate=not evaluated, dview=cluster)
+        if not evaluated:
+            ckpt.save('eval', cnm.save)
+
+        # Visualize the patches
+        if len(cnm.estimates.C) > 0:
+            logging.info("Visualizing patches...")
+            outfile = os.path.join(output_dir, base_fname + "_cmn-bokeh-traces.html")
+            bokeh.io.output_file(outfile)
+            nb_view_patches(
+                Yr, 
+                cnm.estimates.A.tocsc(), 
+                cnm.estimates.C, 
+                cnm.estimates.b, 
+                cnm.estimates.f,
+                dims[0],
+                dims[1],
+                YrA=cnm.estimates.YrA, 
+                image_neurons=cn_filter,
+                denoised_color="red", 
+                thr=0.8, 
+                cmap="gray"
             )
-        finally: 
-            # Regardless of whether the CNMF algorithm runs successfully or not, close the cluster
-            close_cluster()
-    
-    # Reset the logger level
-    logging.disable(logging.NOTSET)    
+            bokeh.io.reset_output()
+            logging.info(f"Output saved to {outfile}")
+        else:
+            logging.warning("No components found to visualize patches")
+    except BaseException:
+        # Remove the memory-mapped file created by this run, unless a checkpoint references it (for a retry to resume from)
+        if not mm['is_input'] and not ckpt.has('memmap'):
+            remove_memmap(fname_new)
+        raise
+    finally: 
+        # Reset the logger level, even if CaImAn failed
+        logging.disable(logging.NOTSET)
 
-    # Check if any components were found
-    if cnm.estimates.C.shape[0] == 0:
-        logging.error(f"No components found in file {base_fname}")
+    # Remove the memory-mapped file created by this run (not the input) and the checkpoints, now that CNMF is finished
+    del Y, Yr
+    if not mm['is_input']:
+        remove_memmap(fname_new)
+    ckpt.clear()
+    return predicted
 
-    # Save the output  
-    save_caiman_output(cnm, cn_filter, pnr, base_fname, args.output_dir)
+def image_log_handler(output_dir: str, base_fname: str) -> logging.Handler:
+    """
+    Creates the log file handler of one image, which is attached to the root logger while the image is processed.
+    Args:
+        output_dir: The output directory of the image
+        base_fname: The base name of the image file
+    Returns:
+        The log file handler of the image
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    handler = logging.FileHandler(os.path.join(output_dir, base_fname + "_caiman.log"), mode="w")
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    return handler
 
-    # Set the estimates
-    cnm_eval_estimates(cnm, Y, frate, base_fname, args.output_dir)
+def remove_partial_output(output_dir: str, log_file: str) -> None:
+    """
+    Removes the outputs of a failed image, except its log, so that downstream steps do not use partial outputs.
+    Args:
+        output_dir: The output directory of the image
+        log_file: The log file of the image, which is kept
+    """
+    for x in os.scandir(output_dir):
+        if x.is_file() and os.path.abspath(x.path) != os.path.abspath(log_file):
+            os.remove(x.path)
 
-    # Visualize the patches
-    if len(cnm.estimates.C) > 0:
-        logging.info("Visualizing patches...")
-        outfile = os.path.join(args.output_dir, base_fname + "_cmn-bokeh-traces.html")
-        bokeh.io.output_file(outfile)
-        nb_view_patches(
-            Yr, 
-            cnm.estimates.A.tocsc(), 
-            cnm.estimates.C, 
-            cnm.estimates.b, 
-            cnm.estimates.f,
-            dims[0],
-            dims[1],
-            YrA=cnm.estimates.YrA, 
-            image_neurons=cn_filter,
-            denoised_color="red", 
-            thr=0.8, 
-            cmap="gray"
-        )
-        bokeh.io.reset_output()
-        logging.info(f"Output saved to {outfile}")
-    else:
-        logging.warning("No components found to visualize patches")
+def main(args):
+    logging.info("Starting caiman_run.py...")
+    # Pair the frame rate files with the image files
+    if len(args.inputs) % 2 != 0:
+        parser.error("The inputs must be pairs of a frame rate file and an image file")
+    frate_files, img_files = args.inputs[0::2], args.inputs[1::2]
+    objects_files = args.objects_file if args.objects_file is not None else [None] * len(img_files)
+    if len(objects_files) != len(img_files):
+        parser.error(f"Expected one objects file per image ({len(img_files)}), but got {len(objects_files)}")
+    per_image_dirs = args.per_image_dirs or len(img_files) > 1
+    logging.info(f"Number of images: {len(img_files)}")
+
+    # Set the number of processes, so the predicted peak memory of the largest movie fits in the available memory
+    available = available_memory(args.memory_limit * (1 << 30) if args.memory_limit is not None else None)
+    stride = cnmf_stride(args.gSig)
+    processes = args.processes
+    for img_file in img_files:
+        dims, T = movie_shape(img_file)
+        processes = min(processes, plan_processes(dims, T, args.rf, stride, args.ssub, args.tsub, args.processes, available))
+    logging.info(f"Available memory: {format_bytes(available)}; using {processes} of {args.processes} processes")
+
+    # Set the cluster for parallel processing, once for all of the images
+    # (the correlation images, CNMF, and the evaluation of each image)
+    n_processes = setup_cluster(processes)
+    failed = []
+    try:
+        for i, (frate_file, img_file, objects_file) in enumerate(zip(frate_files, img_files, objects_files), 1):
+            base_fname = get_base_fname(img_file)
+            output_dir = os.path.join(args.output_dir, base_fname) if per_image_dirs else args.output_dir
+            logging.info(f"Processing image {i} of {len(img_files)}: {img_file}")
+            handler = image_log_handler(output_dir, base_fname)
+            logging.getLogger().addHandler(handler)
+            try:
+                with PeakRSS() as rss:
+                    predicted = process_image(frate_file, img_file, objects_file, output_dir, args, n_processes, available)
+                if predicted is not None:
+                    logging.info(f"Peak memory: predicted {format_bytes(predicted)}, measured {format_bytes(rss.peak)} (summed RSS of the main and worker processes)")
+            except Exception:
+                # a failed image does not stop the others; it is logged to its own log
+                logging.exception(f"CaImAn failed on image {img_file}")
+                failed.append(img_file)
+                if per_image_dirs:
+                    remove_partial_output(output_dir, handler.baseFilename)
+                # the worker pool may be left in a bad state, so it is replaced for the next image
+                if i < len(img_files):
+                    n_processes = setup_cluster(processes)
+            finally:
+                logging.getLogger().removeHandler(handler)
+                handler.close()
+    finally:
+        # Regardless of whether CaImAn runs successfully or not, close the cluster (once, after all images)
+        close_cluster()
+
+    # Fail only if no image could be processed
+    if failed:
+        logging.error(f"CaImAn failed on {len(failed)} of {len(img_files)} images: {', '.join(failed)}")
+        if len(failed) == len(img_files):
+            sys.exit(1)
 
 if __name__ == "__main__":
     args = parser.parse_args()
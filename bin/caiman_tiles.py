@@ -0,0 +1,65 @@
+# import
+## batteries
+import logging
+## 3rd party
+import numpy as np
+import caiman as cm
+## package
+from tiles import tile_grid
+
+
+# functions
+def correlation_pnr_halo(gSig: int) -> int:
+    """
+    Gets the halo of a tile for the correlation and peak-to-noise ratio images: the radius of the
+    spatial filter (2*gSig) plus the 1 pixel neighbourhood of the local correlations,
+    so the images of the pixels owned by a tile do not depend on the tile edges.
+    Args:
+        gSig: The gaussian width of the neuron kernel.
+    Returns:
+        The halo (pixels).
+    """
+    return 2 * gSig + 1
+
+def correlation_pnr_tile(task: tuple) -> tuple:
+    """
+    Computes the correlation and peak-to-noise ratio images of one tile (in a worker process).
+    Args:
+        task: The (memmap file, (y0, x0, y1, x1) window, (y0, x0, y1, x1) owned box, gSig) of the tile.
+    Returns:
+        The owned box, and the correlation and peak-to-noise ratio images of the owned box.
+    """
+    fname, (y0, x0, y1, x1), (oy0, ox0, oy1, ox1), gSig = task
+    Yr, dims, T = cm.load_memmap(fname)
+    Y = Yr.T.reshape((T,) + dims, order="F")
+    cn, pnr = cm.summary_images.correlation_pnr(np.array(Y[:, y0:y1, x0:x1]), gSig=gSig, swap_dim=False)
+    own = (slice(oy0 - y0, oy1 - y0), slice(ox0 - x0, ox1 - x0))
+    return (oy0, ox0, oy1, ox1), cn[own], pnr[own]
+
+def parallel_correlation_pnr(fname: str, gSig: int, dview, n_processes: int) -> tuple:
+    """
+    Computes the correlation and peak-to-noise ratio images over overlapping spatial tiles in the worker pool,
+    and stitches them. The tiles overlap by twice the halo (see `correlation_pnr_halo`), so the result matches
+    `cm.summary_images.correlation_pnr` on the full movie (within floating-point tolerance).
+    Each worker reads its tile from the memmap file, so the movie is not sent to the workers.
+    Args:
+        fname: The CaImAn memmap file of the movie.
+        gSig: The gaussian width of the neuron kernel.
+        dview: The worker pool (e.g., from `cm.cluster.setup_cluster`).
+        n_processes: The number of worker processes, which sets the number of tiles (~2 per process).
+    Returns:
+        The (Y, X) correlation and peak-to-noise ratio images.
+    """
+    _, dims, _ = cm.load_memmap(fname)
+    halo = correlation_pnr_halo(gSig)
+    n_side = int(np.ceil(np.sqrt(2 * n_processes)))
+    tile_size = max(int(np.ceil(max(dims) / n_side)) + 2 * halo, 4 * halo)
+    grid = tile_grid(dims, tile_size, 2 * halo)
+    logging.info(f"Computing the correlation and peak-to-noise ratio images in {len(grid)} tiles (halo {halo})...")
+    results = dview.map(correlation_pnr_tile, [(fname, window, own, gSig) for window, own in grid])
+    cn = np.zeros(dims, dtype=results[0][1].dtype)
+    pnr = np.zeros(dims, dtype=results[0][2].dtype)
+    for (oy0, ox0, oy1, ox1), cn_tile, pnr_tile in results:
+        cn[oy0:oy1, ox0:ox1] = cn_tile
+        pnr[oy0:oy1, ox0:ox1] = pnr_tile
+    return cn, pnr
@@ -11,8 +11,7 @@ import numpy as np
 import tifffile
 from tqdm import tqdm
 ## local
-from load_czi import load_image_data_czi
-from load_tiff import load_image_data_moldev, load_image_data_moldev_concat
+from image_source import ImageSource
 from calc_dff_f0_utils import (
     check_and_load_file, calc_mean_signal, create_montage, convert_f_to_dff_perc, draw_dff_activity, 
     plot_montage, define_slice_extraction, save_dff_dat
@@ -45,6 +44,8 @@ parser.add_argument("-o", "--output-dir", type=str, default='output',
 parser.add_argument("-f", "--file-type", type=str, default='zeiss',
                     choices = ['moldev', 'zeiss'], 
                     help="Input file type")
+parser.add_argument("--mean-projection", type=str, default=None,
+                    help="Mean projection of the image (*_meanprojection.tif from mask.py). If not provided, it is computed from the image.")
 parser.add_argument('--p_th', type=float, default=0.75,
                     help='Threshold percentile for image processing')
 parser.add_argument('--f_baseline_perc', type=float, default=8,
@@ -53,43 +54,37 @@ parser.add_argument('--win_sz', type=int, default=500,
                     help='Window size for the percent filter.')
 
 # functions
-def read_img_file(img_file: str, file_type: str) -> Tuple[np.ndarray, float, tuple, list, np.ndarray]:
+def read_img_file(img_file: str, file_type: str, mean_projection: str=None) -> Tuple[ImageSource, float, tuple, list, np.ndarray]:
     """
     Read the image file and return the image data, frame rate, image shape, image size and average image.
+    The image data is opened lazily as a (T, Y, X) view, and the average image is read from
+    the mean projection file if provided (else computed chunk-by-chunk), so the movie is never fully loaded into memory.
     Args:
         img_file: path to the image file
         file_type: type of the image file
+        mean_projection: path to the mean projection of the image file (optional)
     Returns:
         tuple of image data
-        - im: image data
+        - im: (T, Y, X) image data
         - frate: frame rate
         - im_shape: image shape
         - im_sz: image size
         - im_avg: average image
     """
     # Load the image data
-    if file_type.lower() == 'moldev' and img_file.endswith('_full.tif'):
-        # Load the concatenated tiff file
-        im, frate = load_image_data_moldev_concat(img_file)
-    elif file_type.lower() == 'moldev':
-        # Extract the image data if from moldev instrument
-        im, frate = load_image_data_moldev(img_file)
-    elif file_type.lower() == 'zeiss':
-        # Extract the image data if czi file form zeiss instrument
-        im, frate = load_image_data_czi(img_file)
-    else:
-        raise ValueError(f"Unknown file type: {file_type}")
+    im = ImageSource(img_file, file_type)
+    frate = im.frate
         
     # Get the image shape and size
     im_shape = im.shape
-    if file_type.lower() == 'moldev':
-        im_sz = [im_shape[1], im_shape[2]]
-        im_avg = np.mean(im, axis=0)
-    elif file_type.lower() == 'zeiss':
-        im_sz = [im_shape[3], im_shape[4]]
-        im_avg = np.squeeze(np.mean(im, axis=1))
+    im_sz = [im_shape[1], im_shape[2]]
+    if mean_projection is not None:
+        logging.info(f"Reading mean projection: {mean_projection}")
+        im_avg = tifffile.imread(mean_projection).astype(np.float64)
+        if im_avg.shape != tuple(im_sz):
+            raise ValueError(f"Mean projection shape {im_avg.shape} does not match the image size {im_sz}")
     else:
-        raise ValueError(f"Unknown file type: {file_type}")
+        im_avg = im.mean()
 
     # stats
     logging.info(f"Frame rate: {frate}")
@@ -112,7 +107,7 @@ def main(args):
 
     # Read the image file and get various parameters
     logging.info(f"Reading image file: {args.img_file}")
-    im, frate, im_shape, im_sz, im_avg = read_img_file(args.img_file, args.file_type)
+    im, frate, im_shape, im_sz, im_avg = read_img_file(args.img_file, args.file_type, args.mean_projection)
 
     # Check if the mask file is provided
     logging.info(f"Reading image masks file: {args.img_masks_file}")
@@ -194,9 +189,7 @@ def main(args):
             plot_montage(montage_image, outfile_montage_filtered)
 
     # Define the slice extraction logic based on file type
-    f_dat, slice_indices, slice_extraction = define_slice_extraction(
-        args.file_type, A, im, im_shape, im_bg
-    )
+    f_dat, slice_indices, slice_extraction = define_slice_extraction(A, im_shape)
 
     # Process each z-slice of the image to compute mean fluorescence
     f_dat = calc_mean_signal(
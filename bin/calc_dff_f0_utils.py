@@ -18,34 +18,23 @@ def save_dff_dat(f_dat, dff_dat, base_fname, output_dir):
     np.save(os.path.join(output_dir, f'{base_fname}_f-dat.npy'), f_dat)
     np.save(os.path.join(output_dir, f'{base_fname}_dff-dat.npy'), dff_dat)
 
-def define_slice_extraction(file_type: str, A: np.ndarray, im: np.ndarray,
-                            im_shape: np.ndarray, im_bg: np.ndarray) -> tuple:
+def define_slice_extraction(A: np.ndarray, im_shape: tuple) -> tuple:
     """
-    Define the slice extraction logic based on file type.
+    Define the slice extraction logic for the (T, Y, X) image data.
     Args:
-        file_type: Type of the file being processed.
         A: Spatial components matrix.
-        im: Image data.
-        im_shape: Shape of the image data.
-        im_bg: Background image data.
+        im_shape: (T, Y, X) shape of the image data.
     Returns:
         f_dat: Fluorescence data matrix.
         slice_indices: Indices for slicing the image data.
         slice_extraction: Function for extracting slices from the image data.
     """
-    logging.info(f'Defining slice extraction for {file_type}')
+    logging.info('Defining slice extraction')
 
-    # Define slice extraction logic based on file type
-    if file_type.lower() == 'moldev':
-        # Initialize storage for fluorescence data if moldev
-        f_dat = np.zeros((A.shape[1], im_shape[0]), dtype='float')
-        slice_indices = range(im.shape[0])
-        slice_extraction = lambda im, z: im[z, :, :]
-    elif file_type.lower() == 'zeiss':
-        # Initialize storage for fluorescence data
-        f_dat = np.zeros((A.shape[1], im.shape[1]), dtype='float')
-        slice_indices = range(im.shape[1])
-        slice_extraction = lambda im, z: im[0, z, 0, :, :]
+    # Initialize storage for fluorescence data
+    f_dat = np.zeros((A.shape[1], im_shape[0]), dtype='float')
+    slice_indices = range(im_shape[0])
+    slice_extraction = lambda im, z: im[z]
 
     return f_dat, slice_indices, slice_extraction
 
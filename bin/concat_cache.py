@@ -0,0 +1,161 @@
+# import
+## batteries
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+# Bump if the concatenated output format changes, which invalidates all cached entries
+CACHE_VERSION = 1
+# Name of the cached image in each cache entry
+CACHE_IMAGE = "image.tif"
+
+
+# functions
+def cache_key(files: list, **options) -> str:
+    """
+    Computes the content-addressed key of a concatenated image.
+    The key is based on the part files (resolved path, size, and modification time),
+    in the order they are concatenated, and on any options that change the output (e.g., compression).
+    Args:
+        files: List of part file paths, in concatenation order.
+        options: Options that change the output.
+    Returns:
+        The hex digest of the key.
+    """
+    parts = []
+    for f in files:
+        st = os.stat(f)
+        parts.append([os.path.realpath(f), st.st_size, st.st_mtime_ns])
+    payload = json.dumps(
+        {'version': CACHE_VERSION, 'parts': parts, 'options': options}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def entry_dir(cache_dir: str, key: str) -> str:
+    """
+    Gets the directory of a cache entry.
+    Args:
+        cache_dir: The cache directory.
+        key: The cache key.
+    Returns:
+        The path to the entry directory.
+    """
+    return os.path.join(cache_dir, key[:2], key)
+
+def link_file(src: str, dst: str) -> None:
+    """
+    Places `src` at `dst` without copying if possible: hardlink, then copy (e.g., across file systems).
+    A symlink is never used, since the cache entry may be evicted while `dst` is still in use.
+    Args:
+        src: The source file.
+        dst: The destination path (overwritten if it exists).
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def cache_fetch(cache_dir: str, key: str, output_file: str) -> bool:
+    """
+    Serves a cached image, if present, and marks the entry as recently used.
+    Args:
+        cache_dir: The cache directory.
+        key: The cache key.
+        output_file: Where to place the cached image.
+    Returns:
+        True if the image was served from the cache.
+    """
+    entry = entry_dir(cache_dir, key)
+    cached = os.path.join(entry, CACHE_IMAGE)
+    if not os.path.isfile(cached):
+        return False
+    try:
+        link_file(cached, output_file)
+        # the entry directory mtime records the last use (for LRU eviction)
+        os.utime(entry)
+    except FileNotFoundError:
+        # evicted by a concurrent process
+        return False
+    return True
+
+def cache_store(cache_dir: str, key: str, output_file: str) -> None:
+    """
+    Adds a concatenated image to the cache.
+    The entry is assembled in a temporary directory and renamed into place,
+    so concurrent processes never see a partial entry.
+    Args:
+        cache_dir: The cache directory.
+        key: The cache key.
+        output_file: The concatenated image.
+    """
+    entry = entry_dir(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(entry))
+    try:
+        # hardlink the image into the cache if possible, since the work directory copy may be removed
+        try:
+            os.link(output_file, os.path.join(tmp_dir, CACHE_IMAGE))
+        except OSError:
+            shutil.copy2(output_file, os.path.join(tmp_dir, CACHE_IMAGE))
+        os.rename(tmp_dir, entry)
+    except OSError as e:
+        # e.g., the entry was stored by a concurrent process
+        logging.warning(f"Could not store cache entry {key}: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def entry_size(entry: str) -> int:
+    """
+    Gets the total size of the files in a cache entry.
+    Args:
+        entry: The entry directory.
+    Returns:
+        The size in bytes.
+    """
+    size = 0
+    with os.scandir(entry) as it:
+        for x in it:
+            if x.is_file(follow_symlinks=False):
+                size += x.stat(follow_symlinks=False).st_size
+    return size
+
+def cache_evict(cache_dir: str, max_bytes: int) -> list:
+    """
+    Removes the least recently used entries until the cache is no larger than `max_bytes`.
+    Args:
+        cache_dir: The cache directory.
+        max_bytes: The size limit of the cache.
+    Returns:
+        The keys of the evicted entries.
+    """
+    # list all entries, with their last use and size
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return []
+    with os.scandir(cache_dir) as shards:
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            with os.scandir(shard.path) as it:
+                for x in it:
+                    if x.is_dir() and not x.name.startswith(".tmp_"):
+                        entries.append((x.stat().st_mtime, entry_size(x.path), x.name, x.path))
+    total = sum(x[1] for x in entries)
+
+    # remove the oldest entries first
+    evicted = []
+    for _, size, key, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted.append(key)
+    if evicted:
+        logging.info(f"  Evicted {len(evicted)} cache entries; cache size: {total / 1e9:.2f} GB")
+    return evicted
@@ -8,13 +8,16 @@ import gc
 import shutil
 import logging
 import argparse
+import itertools
 import xml.etree.ElementTree as ET
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 ## 3rd party
 import numpy as np
 import tifffile
 ## package
-from load_tiff import load_image_data_moldev_concat
+from load_tiff import probe_image, tiff_compression_args, TIFF_COMPRESSIONS
+from concat_cache import cache_key, cache_fetch, cache_store, cache_evict
 
 
 # logging
@@ -31,7 +34,14 @@ epi = """DESCRIPTION:
     1. Creates a new directory for storing the combined TIFF files.
     2. Checks if any combined files already exist to avoid reprocessing.
     3. Concatenates the image data from related TIFF files and saves the combined images.
+       Frames are streamed to the output in chunks (see --chunk-frames), so the full movie is never held in memory.
+       The next chunks are read by --threads worker threads while the current chunk is written.
+       If --compression is set, each frame is compressed in strips of --rows-per-strip rows (see --threads),
+       which keeps per-frame reads cheap for the downstream steps.
     4. Preserves metadata from the first file in each group during the save process.
+    If --cache-dir is set, the combined image is looked up in the cache first, keyed on the (sorted) part files,
+    their sizes and modification times, and the output options. Cache hits are hardlinked (or copied) to the output,
+    so unchanged groups are not re-concatenated. The least recently used entries are evicted beyond --cache-max-gb.
 """
 parser = argparse.ArgumentParser(description=desc, epilog=epi,
                                  formatter_class=CustomFormatter)
@@ -39,94 +49,134 @@ parser.add_argument('img_files', type=str, nargs='+',
                     help='Image files')
 parser.add_argument('-o', '--output', type=str, default='combined.tif',
                     help='Output image file')
+parser.add_argument('--chunk-frames', type=int, default=256,
+                    help='Max number of frames held in memory while streaming the parts to the output. If <1, whole part files are read at once')
+parser.add_argument('-t', '--threads', type=int, default=4,
+                    help='Number of threads for reading (prefetching) the part files. At most threads+1 chunks are held in memory')
+parser.add_argument('--compression', type=str, default='none', choices=TIFF_COMPRESSIONS,
+                    help='Compression of the output TIFF file')
+parser.add_argument('--compression-level', type=int, default=None,
+                    help='Compression level. If not provided, the codec default is used')
+parser.add_argument('--rows-per-strip', type=int, default=64,
+                    help='Image rows per compressed strip; strips are compressed by --threads threads')
+parser.add_argument('--cache-dir', type=str, default=None,
+                    help='Persistent cache directory for combined images. If not provided, no caching')
+parser.add_argument('--cache-max-gb', type=float, default=500,
+                    help='Max size of the cache (GB)')
 parser.add_argument('--version', action='version', version='0.1.0')
 
-def find_tiff_files(input_dir: str) -> list:
+def read_tiff_shape(fname: str) -> tuple:
     """
-    Recursively find all TIFF files in the input directory
+    Read the shape and dtype of a TIFF file from its header, without loading the pixel data
     Args:
-        input_dir: Path to the directory containing TIFF files
+        fname: Path to the TIFF file
     Returns:
-        List of TIFF file paths
+        tuple of (shape, dtype), with the shape as (frames, height, width)
     """
-    # recursively find all "*.tif" files
-    logging.info(f"Searching for TIFF files in: {input_dir}")
-    tif_files = []
-    for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith('.tif'):
-                tif_files.append(os.path.join(root, file))
-    logging.info(f"  Found {len(tif_files)} TIFF files")
-    return tif_files
-
-def group_tiff_files(tif_files: list) -> dict:
+    with tifffile.TiffFile(fname) as tif:
+        series = tif.series[0]
+        shape, dtype = series.shape, series.dtype
+    # a single-page file is a single frame
+    if len(shape) == 2:
+        shape = (1,) + tuple(shape)
+    return tuple(shape), dtype
+
+def natural_sort_key(fname: str) -> list:
     """
-    Group related TIFF files by their base name
+    Sort key that orders the numbers in a file name numerically (e.g., `-file10` after `-file9`)
     Args:
-        tif_files: List of TIFF file paths
+        fname: File name
     Returns:
-        Dictionary of related TIFF files grouped by their base name
+        List of the text and integer parts of the file name
     """
-    # group files by basename
-    logging.info("Grouping files by base name")
-    file_groups = {}
-    pattern = re.compile(r"(.+?)(-file\d+)?\.tif$")
-    for filename in tif_files:
-        # Match the filename against the pattern
-        match = pattern.match(filename)
-        if match:
-            # Extract the base name and part suffix
-            base_name, part_suffix = match.groups()
-            # Group files by their base name
-            if base_name in file_groups:
-                file_groups[base_name].append(filename)
-            else:
-                file_groups[base_name] = [filename]
-    logging.info(f"  Found {len(file_groups)} groups of related files")
-    return file_groups
-
-def filter_tiff_files(file_groups: dict, test_image_nums: str, test_image_count: int) -> dict:
+    return [int(x) if x.isdigit() else x for x in re.split(r'(\d+)', fname)]
+
+def read_frames(fname: str, start: int, stop: int) -> np.ndarray:
     """
-    Filter the groups of TIFF files based on the provided test_image_nums or test_image_count
+    Read a range of frames from a TIFF file
     Args:
-        file_groups: Dictionary of related TIFF files grouped by their base name
-        test_image_nums: Comma-delimited list of indices to select specific image groups
-        test_image_count: Number of randomly selected image groups to process
+        fname: Path to the TIFF file
+        start: Index of the first frame
+        stop: Index after the last frame
     Returns:
-        Dictionary of filtered TIFF files grouped by their base name
+        Frames as a (frames, height, width) array
+    """
+    with tifffile.TiffFile(fname) as tif:
+        chunk = tif.asarray(key=range(start, stop), series=0)
+    # a single page is returned as a 2D array
+    if chunk.ndim == 2:
+        chunk = chunk[np.newaxis]
+    return chunk
+
+def iter_frames(files: list, n_frames: list, chunk_frames: int=256, threads: int=4):
+    """
+    Stream the frames of the TIFF files, in order.
+    Chunks of `chunk_frames` frames are read concurrently by `threads` threads, 
+    which prefetch the next chunks while the current one is consumed; 
+    at most `threads + 1` chunks are held in memory.
+    Args:
+        files: List of TIFF file paths
+        n_frames: Number of frames in each file
+        chunk_frames: Max number of frames to read at once. If <1, each file is read in full.
+        threads: Number of reader threads
+    Yields:
+        Individual frames (2D arrays)
     """
-    group_ids = None
-    if test_image_count > 0:
-        # randomly select N image groups
-        logging.info(f"Selecting {test_image_count} random image groups")
-        group_ids = np.random.choice(list(file_groups.keys()), test_image_count, replace=False)
-    elif test_image_nums is not None:
-        # select specific image groups to process
-        logging.info("Selecting specific image groups")
-        test_image_nums = [int(i) for i in test_image_nums.split(',')]
-        group_ids = list(file_groups.keys())
-        group_ids = [group_ids[i] for i in test_image_nums if i < len(group_ids)]
-    # group files by basename
-    if group_ids is not None:
-        file_groups = {k: v for k, v in file_groups.items() if k in group_ids}
-    return file_groups
-
-def concatenate_images(files: list, output_file: str) -> None:
+    # chunks to read, in output order
+    chunks = []
+    for f, n in zip(files, n_frames):
+        step = chunk_frames if chunk_frames > 0 else n
+        chunks += [(f, start, min(start + step, n)) for start in range(0, n, step)]
+    chunks = iter(chunks)
+    threads = max(threads, 1)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # prefetch the first chunks
+        pending = deque(executor.submit(read_frames, *x) for x in itertools.islice(chunks, threads))
+        while pending:
+            # wait for the next chunk in order, and queue the read of another one
+            chunk = pending.popleft().result()
+            for x in itertools.islice(chunks, 1):
+                pending.append(executor.submit(read_frames, *x))
+            for frame in chunk:
+                yield frame
+            del chunk
+
+def concatenate_images(
+    files: list, output_file: str, chunk_frames: int=256, threads: int=4, 
+    compression: str='none', compression_level: int=None, rows_per_strip: int=64
+    ) -> None:
     """
-    Concatenate the image data from related TIFF files and save the combined image
+    Concatenate the image data from related TIFF files and save the combined image.
+    The frames are streamed from the input files to a single TiffWriter, 
+    so only a few chunks of `chunk_frames` frames are held in memory at a time.
     Args:
         files: List of TIFF file paths
-        output_dir: Directory path for storing the combined
+        output_file: Path to the combined output file
+        chunk_frames: Max number of frames to read at once. If <1, each file is read in full.
+        threads: Number of threads for reading the files (and compressing the output)
+        compression: Compression codec of the output file ('none' for uncompressed)
+        compression_level: Compression level (codec default if None)
+        rows_per_strip: Image rows per compressed strip
     """
     # Status 
     logging.info(f"Concatenating {len(files)} images to: {output_file}")
 
     # Sort files to ensure they are concatenated in the correct order
-    files.sort()
-
-    # Load images and concatenate
-    combined_image = np.concatenate([tifffile.imread(f) for f in files], axis=0)  # Change axis if needed for your images
-    logging.info(f"  Combined image shape: {combined_image.shape}")
+    files.sort(key=natural_sort_key)
+
+    # Get the combined image shape from the file headers
+    n_frames = []
+    frame_shape, dtype = None, None
+    for f in files:
+        shape, f_dtype = read_tiff_shape(f)
+        if frame_shape is None:
+            frame_shape, dtype = shape[1:], f_dtype
+        elif shape[1:] != frame_shape or f_dtype != dtype:
+            raise ValueError(f"Frame shape/dtype of {f} ({shape[1:]}, {f_dtype}) does not match {files[0]} ({frame_shape}, {dtype})")
+        n_frames.append(shape[0])
+    combined_shape = (sum(n_frames),) + frame_shape
+    logging.info(f"  Combined image shape: {combined_shape}")
 
     # Read metadata from the first image
     with tifffile.TiffFile(files[0]) as tif:
@@ -149,20 +199,55 @@ def concatenate_images(files: list, output_file: str) -> None:
     if output_dir != "" and not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Save the combined image with metadata
+    # Stream the frames into the combined image, with metadata
+    write_args = tiff_compression_args(compression, compression_level, rows_per_strip)
+    if write_args:
+        logging.info(f"  Compression: {compression} (level: {compression_level})")
+        write_args['maxworkers'] = threads
+        for tag in ('Compression', 'Predictor', 'RowsPerStrip', 'StripByteCounts'):
+            metadata.pop(tag, None)
     with tifffile.TiffWriter(output_file, bigtiff=True) as tif_writer:
-        tif_writer.write(combined_image, metadata=metadata)
+        tif_writer.write(
+            iter_frames(files, n_frames, chunk_frames, threads), shape=combined_shape, dtype=dtype, metadata=metadata,
+            **write_args
+        )
     logging.info(f"  Saved combined image: {output_file}")
 
 def main(args):
-    # Concatenate the images
     logging.info("Starting concatenate_moldev_files.py...")
-    concatenate_images(args.img_files, args.output)
+    # Sort the part files in concatenation order
+    args.img_files.sort(key=natural_sort_key)
+
+    # Serve the combined image from the cache, if unchanged
+    key, cache_hit = None, False
+    if args.cache_dir is not None:
+        key = cache_key(
+            args.img_files, compression=args.compression, 
+            compression_level=args.compression_level, rows_per_strip=args.rows_per_strip
+        )
+        output_dir = os.path.dirname(args.output)
+        if output_dir != "":
+            os.makedirs(output_dir, exist_ok=True)
+        cache_hit = cache_fetch(args.cache_dir, key, args.output)
+        logging.info(f"Cache {'hit' if cache_hit else 'miss'}: {key}")
+
+    # Concatenate the images
+    if not cache_hit:
+        concatenate_images(
+            args.img_files, args.output, args.chunk_frames, args.threads,
+            args.compression, args.compression_level, args.rows_per_strip
+        )
+
+    # Add the combined image to the cache
+    if key is not None and not cache_hit:
+        cache_store(args.cache_dir, key, args.output)
+        cache_evict(args.cache_dir, int(args.cache_max_gb * 1e9))
 
     # Check the format of the output
     logging.info("Checking the format of the output...")
     gc.collect()
-    load_image_data_moldev_concat(args.output)
+    props = probe_image(args.output)
+    logging.info(f"  Frame rate: {props['frate']}; shape: {props['shape']}; dtype: {props['dtype']}")
 
 ## script main
 if __name__ == '__main__':
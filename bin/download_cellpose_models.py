@@ -5,9 +5,8 @@ from __future__ import print_function
 import os
 import logging
 import argparse
-## 3rd party
-import numpy as np
-from cellpose import models
+## package
+from model_store import populate_store, MODEL_FILES
 
 # logging
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
@@ -19,17 +18,20 @@ class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
 
 desc = "Download cellpose models"
 epi = """DESCRIPTION:
-Download cellpose models for nuclei and cytoplasmic segmentation.
+Download cellpose models for nuclei and cytoplasmic segmentation to a (persistent) model store.
+Only missing or corrupted weights are downloaded, as checked against the store checksums (checksums.json),
+so a populated store is resolved offline.
+Point CELLPOSE_LOCAL_MODELS_PATH to the store to load the models from it.
 """
 parser = argparse.ArgumentParser(description=desc, epilog=epi,
                                  formatter_class=CustomFormatter)
 parser.add_argument("output_dir", type=str,
-                    help="Output directory to save models")
+                    help="Output directory to save models (the model store)")
+parser.add_argument("--model-types", type=str, nargs='+', default=['nuclei', 'cyto3'],
+                    choices=list(MODEL_FILES.keys()), help="Cellpose model types")
 
 def main(args):
-    os.makedirs(args.output_dir, exist_ok=True)
-    nuclei_model = models.Cellpose(gpu=False, model_type='nuclei')
-    cyto3_model = models.Cellpose(gpu=False, model_type='cyto3')
+    populate_store(args.output_dir, args.model_types)
     logging.info(f"Models downloaded to: {args.output_dir}")
 
 ## script main
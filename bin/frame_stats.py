@@ -0,0 +1,149 @@
+# import
+## batteries
+import logging
+## 3rd party
+import numpy as np
+
+# Number of histogram bins for the approximate median of float data (top 16 bits of the float32 bit pattern)
+FLOAT_KEY_BITS = 16
+
+
+# classes
+class FrameStats:
+    """
+    Single-pass statistics of a movie, accumulated chunk-by-chunk, so that the movie is read once
+    and no sorted or masked copies of it are made.
+
+    The median is exact for 8/16-bit integer data (a bincount of the values) and approximate otherwise:
+    the finite values are binned by the top bits of their float32 bit pattern, which is monotonic in the value,
+    so the median is found within a relative error of ~1%.
+
+    Attributes:
+        count: The number of values.
+        n_nan: The number of NaN values.
+        n_inf: The number of +/-inf values.
+        n_zero: The number of zero values.
+        min: The min of the finite values.
+        max: The max of the finite values.
+        mean: The mean of the finite values.
+        median: The (approximate) median of the finite values.
+    """
+    def __init__(self, dtype):
+        """
+        Args:
+            dtype: The dtype of the movie.
+        """
+        self.dtype = np.dtype(dtype)
+        self.count = self.n_nan = self.n_inf = self.n_zero = 0
+        self.min = self.max = None
+        self._sum = 0.0
+        self._n_finite = 0
+        # exact bincount for small integers, float bit-pattern histogram otherwise
+        self._exact = self.dtype.kind in 'iub' and self.dtype.itemsize <= 2
+        if self._exact:
+            self._offset = -int(np.iinfo(self.dtype).min) if self.dtype.kind == 'i' else 0
+            n_bins = 2 ** (8 * self.dtype.itemsize)
+        else:
+            n_bins = 2 ** FLOAT_KEY_BITS
+        self._hist = np.zeros(n_bins, dtype=np.int64)
+
+    def update(self, chunk: np.ndarray) -> None:
+        """
+        Adds a chunk of the movie to the statistics.
+        Args:
+            chunk: The chunk of frames.
+        """
+        chunk = np.asarray(chunk)
+        self.count += chunk.size
+        self.n_zero += int(np.count_nonzero(chunk == 0))
+        if chunk.dtype.kind == 'f':
+            finite = np.isfinite(chunk)
+            n_finite = int(np.count_nonzero(finite))
+            n_nan = int(np.count_nonzero(np.isnan(chunk)))
+            self.n_nan += n_nan
+            self.n_inf += chunk.size - n_finite - n_nan
+            if n_finite < chunk.size:
+                chunk = chunk[finite]
+        if chunk.size == 0:
+            return
+        c_min, c_max = chunk.min(), chunk.max()
+        self.min = c_min if self.min is None else min(self.min, c_min)
+        self.max = c_max if self.max is None else max(self.max, c_max)
+        self._sum += float(chunk.sum(dtype=np.float64))
+        self._n_finite += chunk.size
+        if self._exact:
+            keys = chunk.ravel().astype(np.int64) + self._offset
+        else:
+            keys = float_keys(chunk.ravel())
+        self._hist += np.bincount(keys, minlength=len(self._hist))
+
+    @property
+    def mean(self) -> float:
+        return self._sum / self._n_finite if self._n_finite > 0 else np.nan
+
+    @property
+    def median(self) -> float:
+        n = self._n_finite
+        if n == 0:
+            return np.nan
+        cum = np.cumsum(self._hist)
+        lo, hi = np.searchsorted(cum, [(n - 1) // 2 + 1, n // 2 + 1])
+        if self._exact:
+            return (lo + hi) / 2 - self._offset
+        return (float(float_from_key(lo)) + float(float_from_key(hi))) / 2
+
+    def log(self) -> None:
+        """
+        Logs the statistics.
+        """
+        logging.info(f"Min: {self.min}")
+        logging.info(f"Max: {self.max}")
+        logging.info(f"Mean: {self.mean}")
+        logging.info(f"Median: {self.median}{'' if self._exact else ' (approximate)'}")
+        logging.info(f"Contains NaN: {self.n_nan > 0} ({self.n_nan} values)")
+        logging.info(f"Contains inf: {self.n_inf > 0} ({self.n_inf} values)")
+        logging.info(f"Contains zeros: {self.n_zero > 0} ({self.n_zero} values)")
+
+
+# functions
+def float_keys(x: np.ndarray) -> np.ndarray:
+    """
+    Maps values to histogram bins that are monotonic in the value: the top bits of the
+    float32 bit pattern, with the sign handled so that the unsigned patterns sort like the values.
+    Args:
+        x: The finite values.
+    Returns:
+        The bin of each value.
+    """
+    bits = np.asarray(x, dtype=np.float32).view(np.uint32)
+    neg = (bits >> 31).astype(bool)
+    bits = np.where(neg, ~bits, bits | np.uint32(0x80000000))
+    return (bits >> (32 - FLOAT_KEY_BITS)).astype(np.int64)
+
+def float_from_key(key: int) -> np.float32:
+    """
+    Gets the value at the middle of a histogram bin (see `float_keys`).
+    Args:
+        key: The bin.
+    Returns:
+        The value.
+    """
+    bits = np.uint32((int(key) << (32 - FLOAT_KEY_BITS)) | (1 << (31 - FLOAT_KEY_BITS)))
+    bits = bits ^ np.uint32(0x80000000) if bits & np.uint32(0x80000000) else ~bits
+    return np.array(bits, dtype=np.uint32).view(np.float32)
+
+def clean_chunk(chunk: np.ndarray, epsilon: float) -> np.ndarray:
+    """
+    Replaces invalid and small values of a chunk in place: NaN and values below epsilon become epsilon.
+    As when the whole movie was validated at once, the replacement is epsilon cast to the dtype,
+    so for integer data (and epsilon < 1) values below epsilon (zeros and negative values) become 0.
+    Args:
+        chunk: The writable chunk of frames.
+        epsilon: The min value.
+    Returns:
+        The cleaned chunk (the same array).
+    """
+    if chunk.dtype.kind == 'f':
+        chunk[np.isnan(chunk)] = epsilon
+    chunk[chunk < epsilon] = np.asarray(epsilon).astype(chunk.dtype)
+    return chunk
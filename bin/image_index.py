@@ -0,0 +1,204 @@
+# import
+## batteries
+import os
+import re
+import json
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+## 3rd party
+import numpy as np
+
+# Image file extensions per file type
+IMAGE_EXTS = {
+    'moldev': ('.tif', '.tiff'),
+    'zeiss': ('.czi',),
+}
+# Image file name: {group}[-file{part}].{ext}
+PART_PATTERN = re.compile(r"(.+?)(?:-file(\d+))?\.(tif|tiff|czi)$")
+# Bump if the manifest format changes
+MANIFEST_VERSION = 1
+
+# An indexed image file; `part` is None for single-file images
+ImageRecord = namedtuple('ImageRecord', ['path', 'size', 'mtime_ns', 'group', 'part'])
+
+
+# functions
+def parse_part(file_name: str) -> tuple:
+    """
+    Parses the group (base name) and part index of an image file name.
+    Args:
+        file_name: The image file name (e.g., `A01_s1_FITC-file2.tif`).
+    Returns:
+        The group name and the part index (None if not a part file), or (None, None) if not an image file.
+    """
+    match = PART_PATTERN.match(file_name)
+    if match is None:
+        return None, None
+    group, part, _ = match.groups()
+    return group, (int(part) if part is not None else None)
+
+def scan_dir(path: str, exts: tuple) -> dict:
+    """
+    Lists one directory with a single `os.scandir` call.
+    Args:
+        path: The directory path.
+        exts: The image file extensions to keep.
+    Returns:
+        The directory entry: its mtime, its subdirectories, and its image files as [name, size, mtime_ns].
+    """
+    subdirs, files = [], []
+    with os.scandir(path) as it:
+        for x in it:
+            # symlinked directories are not traversed (as with `os.walk`), which also avoids symlink loops
+            if x.is_dir(follow_symlinks=False):
+                subdirs.append(x.name)
+            elif x.name.endswith(exts) and x.is_file():
+                st = x.stat()
+                files.append([x.name, st.st_size, st.st_mtime_ns])
+    return {'mtime_ns': os.stat(path).st_mtime_ns, 'subdirs': subdirs, 'files': files}
+
+def load_manifest(manifest: str, exts: tuple) -> dict:
+    """
+    Loads the directory entries of a previous index.
+    Args:
+        manifest: The manifest file path.
+        exts: The image file extensions of the index.
+    Returns:
+        The directory entries keyed by path (empty if the manifest is missing or was built differently).
+    """
+    if manifest is None or not os.path.isfile(manifest):
+        return {}
+    try:
+        with open(manifest) as inF:
+            data = json.load(inF)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read the index manifest {manifest}: {e}")
+        return {}
+    if data.get('version') != MANIFEST_VERSION or tuple(data.get('exts', [])) != tuple(exts):
+        return {}
+    return data.get('dirs', {})
+
+def write_manifest(manifest: str, dirs: dict, records: list, exts: tuple) -> None:
+    """
+    Writes the index manifest, replacing any previous one atomically.
+    Args:
+        manifest: The manifest file path.
+        dirs: The directory entries keyed by path.
+        records: The indexed image files.
+        exts: The image file extensions of the index.
+    """
+    data = {
+        'version': MANIFEST_VERSION,
+        'exts': list(exts),
+        'dirs': dirs,
+        'files': [r._asdict() for r in records],
+    }
+    manifest_dir = os.path.dirname(manifest)
+    if manifest_dir != "":
+        os.makedirs(manifest_dir, exist_ok=True)
+    tmp_file = f"{manifest}.tmp{os.getpid()}"
+    with open(tmp_file, "w") as outF:
+        json.dump(data, outF)
+    os.replace(tmp_file, manifest)
+
+def index_images(input_dir: str, exts: tuple, manifest: str=None, threads: int=8) -> list:
+    """
+    Recursively indexes the image files in the input directory.
+    Directories are listed in parallel by `threads` threads. If a manifest from a previous run is given,
+    directories whose mtime is unchanged are not re-listed (only their mtime is checked),
+    so a re-run on an unchanged tree only stats the directories. Note that a directory mtime only
+    changes when files are added, removed, or renamed, not when a file is rewritten in place.
+    Args:
+        input_dir: Path to the directory containing the image files.
+        exts: The image file extensions to index.
+        manifest: Path to the manifest file, which is read (if it exists) and updated. If None, no manifest.
+        threads: Number of threads for listing the directories.
+    Returns:
+        List of ImageRecord, sorted by path. The paths are under `input_dir` as given (not resolved).
+    """
+    logging.info(f"Indexing image files in: {input_dir}")
+    exts = tuple(exts)
+    # the resolved path keys the manifest, so it is stable across the (per-run) staged paths of the input directory
+    root = os.path.realpath(input_dir)
+    prev_dirs = load_manifest(manifest, exts)
+    dirs, n_rescanned = {}, 0
+
+    def visit(path):
+        # reuse the previous listing if the directory is unchanged
+        prev = prev_dirs.get(path)
+        if prev is not None and os.stat(path).st_mtime_ns == prev['mtime_ns']:
+            return path, prev, False
+        return path, scan_dir(path, exts), True
+
+    # breadth-first traversal; each level of directories is listed in parallel
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        level = [root]
+        while level:
+            next_level = []
+            for path, entry, rescanned in executor.map(visit, level):
+                dirs[path] = entry
+                n_rescanned += rescanned
+                next_level += [os.path.join(path, x) for x in entry['subdirs']]
+            level = next_level
+
+    # image file records
+    records = []
+    for path, entry in dirs.items():
+        for name, size, mtime_ns in entry['files']:
+            group, part = parse_part(name)
+            if group is not None:
+                records.append(ImageRecord(os.path.join(path, name), size, mtime_ns, group, part))
+    records.sort(key=lambda r: r.path)
+    logging.info(f"  Listed {n_rescanned} of {len(dirs)} directories; found {len(records)} image files")
+
+    # update the manifest
+    if manifest is not None:
+        write_manifest(manifest, dirs, records, exts)
+    # report the paths under the input directory as given, as listed by `os.walk(input_dir)`
+    return [r._replace(path=os.path.join(input_dir, os.path.relpath(r.path, root))) for r in records]
+
+def group_images(records: list) -> dict:
+    """
+    Groups related image files by their base name, in part order.
+    Args:
+        records: List of ImageRecord.
+    Returns:
+        Dictionary of image file paths grouped by their base name
+    """
+    logging.info("Grouping files by base name")
+    file_groups = {}
+    for r in sorted(records, key=lambda r: (r.group, -1 if r.part is None else r.part, r.path)):
+        file_groups.setdefault(r.group, []).append(r.path)
+    logging.info(f"  Found {len(file_groups)} groups of related files")
+    return file_groups
+
+def select_groups(file_groups: dict, test_image_names: str, test_image_count: int) -> dict:
+    """
+    Select the groups of image files based on the provided test_image_names or test_image_count
+    Args:
+        file_groups: Dictionary of files grouped by their base name
+        test_image_names: Comma-delimited list of file basenames to select specific image groups
+        test_image_count: Number of randomly selected image groups to process
+    Returns:
+        Dictionary of filtered image files grouped by their base name
+    """
+    group_ids = None
+    if test_image_count > 0:
+        # randomly select N image groups
+        logging.info(f"Selecting {test_image_count} random image groups")
+        if test_image_count > len(file_groups):
+            raise ValueError("test_image_count is greater than the number of image groups")
+        group_ids = np.random.choice(list(file_groups.keys()), test_image_count, replace=False)
+    elif test_image_names is not None:
+        # select specific image groups to process
+        logging.info("Selecting specific image groups based on --test-image-names")
+        test_image_names = [str(x).strip() for x in test_image_names.split(',')]
+        group_ids = [x for x in file_groups.keys() if x in test_image_names]
+        if len(group_ids) == 0:
+            file_groups_str = ', '.join(file_groups.keys())
+            raise ValueError(f"No matching image groups found. Available groups: {file_groups_str}")
+    # group files by basename
+    if group_ids is not None:
+        file_groups = {k: v for k, v in file_groups.items() if k in group_ids}
+    return file_groups
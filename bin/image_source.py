@@ -0,0 +1,228 @@
+# import
+## batteries
+import logging
+import xml.etree.ElementTree as ET
+## 3rd party
+import numpy as np
+## package
+from load_tiff import (
+    load_tiff_lazy, load_tiff_metadata, extract_frate_concat, get_metadata_value, extract_exposure,
+    iter_frame_chunks, reduce_frames, project_frames
+)
+from load_czi import load_frames_czi
+
+
+# classes
+class ImageSource:
+    """
+    A movie from either instrument, normalized to a lazy (T, Y, X) view.
+
+    MolDev (Tiff) movies are memory-mapped (or opened as a zarr array if compressed),
+    and Zeiss (CZI) movies are decoded frame-by-frame from their subblocks,
+    so indexing and chunked iteration never make format-specific copies of the movie.
+
+    Attributes:
+        fname: The path to the image file.
+        data: The lazy (T, Y, X) image data.
+        frate: The frame rate.
+        shape: The (T, Y, X) shape of the movie.
+        dtype: The dtype of the movie.
+        func: A function applied in place to writable copies of the chunks when they are read (see `map_chunks`), or None.
+    """
+    def __init__(self, fname: str, file_type: str, frate: float=None):
+        """
+        Args:
+            fname: The path to the image file.
+            file_type: 'moldev' or 'zeiss' for instrument files (the frame rate is read from the metadata),
+              or 'tiff' for any other Tiff file (e.g., a masked movie), for which `frate` must be provided.
+            frate: The frame rate. If provided, it is not read from the metadata.
+        """
+        self.fname = fname
+        file_type = file_type.lower()
+        if file_type == 'zeiss':
+            data, file_frate = load_frames_czi(fname)
+        elif file_type in ('moldev', 'tiff'):
+            data = to_txy(load_tiff_lazy(fname))
+            file_frate = None
+            if file_type == 'moldev' and frate is None:
+                file_frate = read_frate_moldev(fname)
+        else:
+            raise ValueError(f"File type not recognized: {file_type}")
+        self.data = data
+        self.frate = frate if frate is not None else file_frate
+        self.func = None
+
+    @classmethod
+    def from_array(cls, data, frate: float=None) -> 'ImageSource':
+        """
+        Wraps an in-memory or memory-mapped (T, Y, X) array.
+        Args:
+            data: The image data.
+            frate: The frame rate.
+        Returns:
+            The image source.
+        """
+        src = cls.__new__(cls)
+        src.fname = getattr(data, 'filename', None)
+        src.data = to_txy(data)
+        src.frate = frate
+        src.func = None
+        return src
+
+    def map_chunks(self, func) -> 'ImageSource':
+        """
+        Lazily applies a function to the movie as it is read, so a transformed movie
+        (e.g., masked) can be streamed to a file without materializing it.
+        Args:
+            func: A function of a writable (n, Y, X) or (Y, X) copy of the data, which may modify it in place,
+              and returns the transformed data (same shape and dtype). Applied on top of any previous function.
+        Returns:
+            The transformed image source (the underlying data is shared).
+        """
+        src = ImageSource.from_array(self.data, self.frate)
+        src.fname = self.fname
+        prev = self.func
+        src.func = func if prev is None else (lambda x: func(prev(x)))
+        return src
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(self.data.shape)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.data.dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if self.func is not None:
+            return self.func(np.array(self.data[key]))
+        return np.asarray(self.data[key])
+
+    def iter_chunks(self, chunk_size: int=100):
+        """
+        Iterates over the movie in chunks of frames.
+        Args:
+            chunk_size: The number of frames per chunk.
+        Yields:
+            The index of the first frame of the chunk and the (n, Y, X) chunk.
+        """
+        yield from iter_frame_chunks(self, chunk_size, axis=0)
+
+    def iter_frames(self, chunk_size: int=100):
+        """
+        Iterates over the frames of the movie, reading them in chunks.
+        Args:
+            chunk_size: The number of frames read at once.
+        Yields:
+            The (Y, X) frames.
+        """
+        for _, chunk in self.iter_chunks(chunk_size):
+            yield from chunk
+
+    def reduce(self, func, chunk_size: int=100) -> np.ndarray:
+        """
+        Reduces the movie over time, touching each frame once.
+        Args:
+            func: A numpy reduction that is associative over chunks (e.g., np.min, np.max, np.sum).
+            chunk_size: The number of frames per chunk.
+        Returns:
+            The (Y, X) reduced image.
+        """
+        return reduce_frames(self, func, axis=0, chunk_size=chunk_size)[0]
+
+    def mean(self, chunk_size: int=100) -> np.ndarray:
+        """
+        Computes the mean image over time, touching each frame once.
+        Args:
+            chunk_size: The number of frames per chunk.
+        Returns:
+            The (Y, X) mean image.
+        """
+        return self.reduce(np.sum, chunk_size) / len(self)
+
+    def projections(self, chunk_size: int=100) -> dict:
+        """
+        Computes the min, max, mean and std images over time together, touching each frame once.
+        Args:
+            chunk_size: The number of frames per chunk.
+        Returns:
+            The (Y, X) projections, keyed by 'min', 'max', 'mean' and 'std'.
+        """
+        return project_frames(self, axis=0, chunk_size=chunk_size)
+
+
+# functions
+def to_txy(im):
+    """
+    Views an image as (T, Y, X), dropping any singleton non-spatial axes (e.g., Zeiss-style
+    (1, T, 1, Y, X) layouts) without copying the data.
+    Args:
+        im: The image data, with the spatial axes last.
+    Returns:
+        The (T, Y, X) view of the image data.
+    """
+    if im.ndim == 3:
+        return im
+    if im.ndim == 2:
+        return im[np.newaxis]
+    n_frames = [x for x in im.shape[:-2] if x != 1]
+    if len(n_frames) > 1:
+        raise ValueError(f"Cannot view an image of shape {im.shape} as (T, Y, X)")
+    return im.reshape((int(np.prod(im.shape[:-2])),) + tuple(im.shape[-2:]))
+
+def read_frate_moldev(fname: str):
+    """
+    Reads the frame rate of a MolDev Tiff file from its metadata.
+    Concatenated files are tried first, followed by raw instrument files.
+    Args:
+        fname: The path to the Tiff file.
+    Returns:
+        The frame rate.
+    """
+    metadata = load_tiff_metadata(fname)
+    try:
+        frate, exposure_units = extract_frate_concat(metadata.get('ImageDescription'), fname)
+    except ValueError:
+        # Not a concatenated file; fall back to the instrument metadata
+        root = ET.fromstring(metadata['ImageDescription'])
+        frate, exposure_units = extract_exposure(get_metadata_value(root, 'Description'))
+    if exposure_units.lower() not in ['msec', 'ms']:
+        logging.warning(f"Exposure units for file {fname} are '{exposure_units}', not 'msec'.")
+    return frate
+
+def caiman_memmap_fname(base: str, dims: tuple, n_frames: int) -> str:
+    """
+    Get the CaImAn memmap file name, which encodes the layout of the data.
+    Args:
+        base: The base of the file name (e.g., path without extension).
+        dims: The (d1, d2) frame dimensions.
+        n_frames: The number of frames.
+    Returns:
+        The memmap file name.
+    """
+    return f"{base}_d1_{dims[0]}_d2_{dims[1]}_d3_1_order_C_frames_{n_frames}_.mmap"
+
+def write_caiman_memmap(src: ImageSource, base: str, chunk_size: int=250) -> str:
+    """
+    Write the (T, Y, X) image data directly in the CaImAn memmap layout 
+    (a C-order float32 array of shape (d1*d2, T), with the pixels in Fortran order),
+    so that `cm.load_memmap` can load it without `cm.save_memmap`.
+    Args:
+        src: The image data.
+        base: The base of the output file name.
+        chunk_size: The number of frames written at once.
+    Returns:
+        The memmap file path.
+    """
+    n_frames, d1, d2 = src.shape
+    outfile = caiman_memmap_fname(base, (d1, d2), n_frames)
+    mmap = np.memmap(outfile, mode='w+', dtype=np.float32, shape=(d1 * d2, n_frames), order='C')
+    for start, chunk in src.iter_chunks(chunk_size):
+        n = chunk.shape[0]
+        mmap[:, start:start + n] = np.reshape(chunk.transpose(1, 2, 0), (d1 * d2, n), order='F')
+    mmap.flush()
+    del mmap
+    return outfile
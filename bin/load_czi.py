@@ -1,13 +1,120 @@
+import io
 import xml.etree.ElementTree as ET
+import numpy as np
 import aicspylibczi
-import xmltodict
 
-def load_image_data_czi(fname: str) -> tuple:
+# numpy dtypes of the CZI pixel types
+CZI_PIXEL_TYPES = {
+    'Gray8': np.uint8,
+    'Gray16': np.uint16,
+    'Gray32': np.uint32,
+    'Gray32Float': np.float32,
+    'Bgr24': np.uint8,
+    'Bgr48': np.uint16,
+    'Bgr96Float': np.float32,
+}
+
+def frames_shape(czi: aicspylibczi.CziFile) -> tuple:
+    """
+    Gets the (T, Y, X) shape of the time series in a CZI file from its subblock directory.
+    Args:
+        czi: The opened CZI file.
+    Returns:
+        The (T, Y, X) shape.
+    """
+    dims_shape = czi.get_dims_shape()[0]
+    return tuple(dims_shape[dim][1] - dims_shape[dim][0] for dim in ('T', 'Y', 'X'))
+
+def pixel_dtype(czi: aicspylibczi.CziFile) -> np.dtype:
+    """
+    Gets the numpy dtype of the pixel type of a CZI file.
+    Args:
+        czi: The opened CZI file.
+    Returns:
+        The dtype, or None if the pixel type is not in `CZI_PIXEL_TYPES`.
+    """
+    pixel_type = czi.pixel_type
+    return np.dtype(CZI_PIXEL_TYPES[pixel_type]) if pixel_type in CZI_PIXEL_TYPES else None
+
+class CziFrames:
+    """
+    Lazy (T, Y, X) view of the time series in a CZI file.
+    Each frame is decoded from its subblocks on demand, using the first index of
+    every other dimension (scene, channel, Z, ...), so the full movie is never held in memory.
+    """
+    def __init__(self, czi: aicspylibczi.CziFile):
+        self.czi = czi
+        dims_shape = czi.get_dims_shape()[0]
+        self.t_start = dims_shape['T'][0]
+        # Fix every non-spatial dimension (other than time) to its first index
+        self.constraints = {
+            dim: dims_shape[dim][0] for dim in czi.dims if dim in aicspylibczi.CziFile.ZISRAW_DIMS and dim != 'T'
+        }
+        self.shape = frames_shape(czi)
+        self.ndim = 3
+        self.dtype = pixel_dtype(czi)
+        if self.dtype is None:
+            self.dtype = self.read_frame(0).dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def read_frame(self, t: int) -> np.ndarray:
+        """
+        Decodes a single frame.
+        Args:
+            t: The time index, relative to the first time point.
+        Returns:
+            The (Y, X) frame.
+        """
+        im, _ = self.czi.read_image(T=self.t_start + t, **self.constraints)
+        return im.reshape(self.shape[1:])
+
+    def __iter__(self):
+        for t in range(self.shape[0]):
+            yield self.read_frame(t)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        t_key, key = key[0], (slice(None),) + key[1:]
+        if t_key is Ellipsis:
+            t_key, key = slice(None), (Ellipsis,) + key[1:]
+        t_idx = range(self.shape[0])[t_key]
+        if isinstance(t_idx, int):
+            return self.read_frame(t_idx)[key[1:]]
+        im = np.empty((len(t_idx),) + self.shape[1:], dtype=self.dtype)
+        for i, t in enumerate(t_idx):
+            im[i] = self.read_frame(t)
+        return im[key]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        im = self[:]
+        return im if dtype is None else im.astype(dtype)
+
+def load_frames_czi(fname: str) -> tuple:
+    """
+    Opens the time series of a CZI file as a lazy (T, Y, X) array and extracts the frame rate.
+
+    Args:
+        fname: The file path of the CZI file to be loaded.
+
+    Returns:
+        A tuple containing the frames and the frame rate.
+           - frames: The `CziFrames` view of the time series.
+           - frate: The frame rate extracted from the metadata.
+    """
+    czi = aicspylibczi.CziFile(fname)
+    return CziFrames(czi), read_frame_rate(czi)
+
+def load_image_data_czi(fname: str, lazy: bool=False) -> tuple:
     """
     Loads image data from a CZI file and extracts the frame rate.
 
     Args:
         fname: The file path of the CZI file to be loaded.
+        lazy: If True, the image data is returned as the (T, Y, X) `CziFrames` view,
+          which decodes frames on demand instead of reading the full movie.
 
     Returns:
         A tuple containing the image data and the frame rate.
@@ -18,43 +125,72 @@ def load_image_data_czi(fname: str) -> tuple:
     czi = aicspylibczi.CziFile(fname)
     
     # Read the image data from the CZI file
-    im, _ = czi.read_image()
-    
-    # Convert the metadata to a string
-    metadata_str = ET.tostring(czi.meta, encoding='unicode')
-    
-    # Parse the metadata string into a dictionary
-    metadata_dict = xmltodict.parse(metadata_str)
+    if lazy:
+        im = CziFrames(czi)
+    else:
+        im, _ = czi.read_image()
     
     # Extract the frame rate from the metadata
-    frate = get_frame_rate_targets(metadata_dict['ImageDocument']['Metadata']['HardwareSetting']['ParameterCollection'])[0]
+    frate = read_frame_rate(czi)
     
     # Return the image data and the frame rate
     return im, frate
 
-def get_frame_rate_targets(parameter_collection: list) -> list:
+def read_frame_rate(czi: aicspylibczi.CziFile) -> float:
     """
-    Extracts frame rate targets from a given parameter collection.
-
-    This function iterates through the collection, checking for the presence of 'FrameRateTarget'.
-    If 'FrameRateTarget' is found, it retrieves its value and adds it to the list of frame rate targets.
+    Reads the frame rate from the metadata of a CZI file.
+    The metadata XML is streamed and only the `HardwareSetting/ParameterCollection`
+    elements are kept, instead of building the full metadata tree.
 
     Args:
-        parameter_collectiom: A list of parameter items, each potentially containing a 'FrameRateTarget'.
+        czi: The opened CZI file.
 
     Returns:
-        frame_rate_targets: A list of extracted frame rate targets.
+        frate: The first frame rate target in the hardware settings.
+
+    Raises:
+        ValueError: If no frame rate target is found.
     """
-    frame_rate_targets = []
-    
-    for item in parameter_collection:
-        if 'FrameRateTarget' in item:
-            # Extract the frame rate target value
-            frame_rate_target = item['FrameRateTarget'].get('#text', None)
-            if frame_rate_target is not None:
-                frame_rate_targets.append(frame_rate_target)
-    
-    return frame_rate_targets
+    target_path = ['ImageDocument', 'Metadata', 'HardwareSetting', 'ParameterCollection']
+    path = []
+    metadata_str = czi.reader.read_meta()
+    for event, elem in ET.iterparse(io.StringIO(metadata_str), events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+        path.pop()
+        if elem.tag == 'FrameRateTarget' and path == target_path and elem.text is not None:
+            return float(elem.text.strip())
+        if path == target_path[:2] and elem.tag == 'HardwareSetting':
+            break
+        # Free the parsed elements that are not needed
+        if len(path) < 3 or path[2] != 'HardwareSetting':
+            elem.clear()
+    raise ValueError("Frame rate target not found in the HardwareSetting/ParameterCollection metadata")
 
+def probe_image(fname: str) -> dict:
+    """
+    Probes a CZI file by parsing only its header (subblock directory and XML metadata);
+    no pixel data is decoded.
 
+    Args:
+        fname: The file path of the CZI file.
 
+    Returns:
+        A dict of the image properties:
+           - frate: The frame rate extracted from the metadata.
+           - exposure_units: Always None; CZI files record a frame rate, not an exposure.
+           - shape: The (T, Y, X) shape of the time series (as read by `load_frames_czi`).
+           - dtype: The dtype of the image data (None if the pixel type is not in `CZI_PIXEL_TYPES`).
+           - nbytes: The size of the (uncompressed) time series in bytes (None if the dtype is unknown).
+    """
+    czi = aicspylibczi.CziFile(fname)
+    shape = frames_shape(czi)
+    dtype = pixel_dtype(czi)
+    return {
+        'frate': read_frame_rate(czi),
+        'exposure_units': None,
+        'shape': shape,
+        'dtype': dtype,
+        'nbytes': int(np.prod(shape)) * dtype.itemsize if dtype is not None else None
+    }
@@ -1,15 +1,24 @@
 import re
 import logging
 import xml.etree.ElementTree as ET
+import numpy as np
 import tifffile
+try:
+    import zarr
+except ImportError:
+    zarr = None
 
-def load_image_data_moldev(fname: str) -> tuple:
+# Compression codecs for intermediate Tiff files (zstd and lzma require imagecodecs)
+TIFF_COMPRESSIONS = ['none', 'zstd', 'zlib', 'lzma']
+
+def load_image_data_moldev(fname: str, lazy: bool=False) -> tuple:
     """
     Loads image data from a Tiff file captured on a Molecular Devices instrument
     and extracts the frame rate.
     
     Args:
         fname: The file path of the Tiff file to be loaded.
+        lazy: If True, the image data is not read into memory (see `load_tiff_lazy`).
     
     Returns:
         A tuple containing the image data and the frame rate.
@@ -17,7 +26,7 @@ def load_image_data_moldev(fname: str) -> tuple:
            - frate: The frame rate extracted from the metadata.
     """
     # Read the image data from the file
-    im = tifffile.imread(fname)
+    im = load_tiff_lazy(fname) if lazy else tifffile.imread(fname)
     
     # Load metadata from the Tiff file
     metadata = load_tiff_metadata(fname)
@@ -32,6 +41,132 @@ def load_image_data_moldev(fname: str) -> tuple:
     # Return the image data and the frame rate
     return im, frate
 
+def load_tiff_lazy(fname: str, maxworkers: int=None):
+    """
+    Opens the image data of a Tiff file without reading it into memory.
+    Uncompressed, contiguous files are memory-mapped; anything else (e.g., compressed files)
+    is opened as a read-only zarr array backed by the Tiff file, which decodes only the
+    pages that are indexed.
+
+    Args:
+    fname (str): The path to the Tiff file.
+    maxworkers (int): The number of threads used to decode the strips of compressed pages.
+
+    Returns:
+    numpy.memmap or zarr.Array: The array-like image data.
+    """
+    try:
+        return tifffile.memmap(fname, mode='r')
+    except ValueError:
+        pass
+    if zarr is None:
+        logging.warning(f"File {fname} cannot be memory-mapped and zarr is not installed; reading it into memory.")
+        return tifffile.imread(fname)
+    return zarr.open(tifffile.imread(fname, aszarr=True, maxworkers=maxworkers), mode='r')
+
+def tiff_compression_args(compression: str='none', level: int=None, rowsperstrip: int=64) -> dict:
+    """
+    Gets the `TiffWriter.write` arguments for writing an intermediate (T, Y, X) movie.
+    Each frame is written as its own page, split into strips of `rowsperstrip` rows, so that
+    compressed movies can still be read one frame at a time and their strips decoded in parallel.
+
+    Args:
+    compression (str): The compression codec ('none', 'zstd', 'zlib', or 'lzma').
+    level (int): The compression level; the codec default is used if None.
+    rowsperstrip (int): The number of image rows per compressed strip.
+
+    Returns:
+    dict: The keyword arguments for `TiffWriter.write` (empty if uncompressed).
+    """
+    if compression is None or compression.lower() == 'none':
+        return {}
+    args = {
+        'compression': compression.lower(),
+        'predictor': True,
+        'rowsperstrip': rowsperstrip,
+    }
+    if level is not None:
+        args['compressionargs'] = {'level': level}
+    return args
+
+def iter_frame_chunks(im, chunk_size: int=100, axis: int=0):
+    """
+    Iterates over an array-like image in chunks of frames along the time axis,
+    so that lazy (memory-mapped or zarr) images are read one chunk at a time.
+
+    Args:
+    im: The (possibly lazy) image data.
+    chunk_size (int): The number of frames per chunk.
+    axis (int): The time axis of the image data.
+
+    Yields:
+    tuple: The index of the first frame of the chunk and the chunk as a numpy array.
+    """
+    n_frames = im.shape[axis]
+    for start in range(0, n_frames, chunk_size):
+        idx = [slice(None)] * len(im.shape)
+        idx[axis] = slice(start, min(start + chunk_size, n_frames))
+        yield start, np.asarray(im[tuple(idx)])
+
+def reduce_frames(im, func, axis: int=0, chunk_size: int=100) -> np.ndarray:
+    """
+    Reduces an array-like image over the time axis chunk-by-chunk, touching each frame once.
+
+    Args:
+    im: The (possibly lazy) image data.
+    func: A numpy reduction that is associative over chunks (e.g., np.min, np.max, np.sum).
+    axis (int): The time axis of the image data.
+    chunk_size (int): The number of frames per chunk.
+
+    Returns:
+    numpy.ndarray: The reduced image, with the time axis kept as size 1.
+    """
+    res = None
+    for _, chunk in iter_frame_chunks(im, chunk_size, axis):
+        chunk = func(chunk, axis=axis, keepdims=True)
+        res = chunk if res is None else func(np.concatenate([res, chunk], axis=axis), axis=axis, keepdims=True)
+    return res
+
+def project_frames(im, axis: int=0, chunk_size: int=100) -> dict:
+    """
+    Computes the min, max, mean and std projections over the time axis in a single chunked pass,
+    so only one chunk of frames is in memory at a time.
+    The mean and std are merged across chunks with Chan's parallel update, in float64.
+
+    Args:
+    im: The (possibly lazy) image data.
+    axis (int): The time axis of the image data.
+    chunk_size (int): The number of frames per chunk.
+
+    Returns:
+    dict: The 'min', 'max', 'mean' and 'std' projections (min/max in the image dtype, mean/std as float32).
+    """
+    im_min = im_max = mean = m2 = None
+    n = 0
+    for _, chunk in iter_frame_chunks(im, chunk_size, axis):
+        chunk = np.asarray(chunk)
+        n_b = chunk.shape[axis]
+        c_min, c_max = chunk.min(axis=axis), chunk.max(axis=axis)
+        c = chunk.astype(np.float64)
+        c_mean = c.mean(axis=axis)
+        c -= np.expand_dims(c_mean, axis)
+        c_m2 = np.square(c, out=c).sum(axis=axis)
+        if n == 0:
+            im_min, im_max, mean, m2 = c_min, c_max, c_mean, c_m2
+        else:
+            np.minimum(im_min, c_min, out=im_min)
+            np.maximum(im_max, c_max, out=im_max)
+            delta = c_mean - mean
+            mean += delta * (n_b / (n + n_b))
+            m2 += c_m2 + delta ** 2 * (n * n_b / (n + n_b))
+        n += n_b
+    return {
+        'min': im_min,
+        'max': im_max,
+        'mean': mean.astype(np.float32),
+        'std': np.sqrt(m2 / n).astype(np.float32),
+    }
+
 def load_tiff_metadata(file_path):
     """
     Loads metadata from a TIFF file.
@@ -88,13 +223,14 @@ def extract_exposure(description):
                 return exposure_time, exposure_units
     return None
 
-def load_image_data_moldev_concat(fname: str) -> tuple:
+def load_image_data_moldev_concat(fname: str, lazy: bool=False) -> tuple:
     """
     Loads image data from a Tiff file captured on a Molecular Devices instrument
     and extracts the frame rate. This is for any file thats been concatenated
     
     Args:
     fname: The file path of the Tiff file to be loaded.
+    lazy: If True, the image data is not read into memory (see `load_tiff_lazy`).
     
     Returns:
     tuple: A tuple containing the image data and the frame rate.
@@ -102,13 +238,36 @@ def load_image_data_moldev_concat(fname: str) -> tuple:
            - frate: The frame rate extracted from the metadata.
     """
     # Read the image data from the file
-    im = tifffile.imread(fname)
+    im = load_tiff_lazy(fname) if lazy else tifffile.imread(fname)
     
     # Load metadata from the Tiff file
     metadata = load_tiff_metadata(fname)
-    image_description = metadata.get('ImageDescription')
 
     # Extract the exposure information from the image description
+    frate, exposure_units = extract_frate_concat(metadata.get('ImageDescription'), fname)
+
+    # Check and print a warning if exposure units are not in msec
+    if exposure_units.lower() not in ['msec', 'ms']:
+        logging.warning(f"Exposure units for file {fname} are '{exposure_units}', not 'msec'.")
+
+    # Return the image data and the frame rate
+    return im, frate
+
+def extract_frate_concat(image_description: str, fname: str) -> tuple:
+    """
+    Extracts the frame rate and exposure units from the image description of a
+    concatenated Molecular Devices Tiff file.
+
+    Args:
+    image_description (str): The ImageDescription tag value of the first page.
+    fname (str): The file path, for error messages.
+
+    Returns:
+    tuple: The frame rate (int) and the exposure units (str).
+
+    Raises:
+    ValueError: If the exposure information is not found or the units are unknown.
+    """
     exposure_units,frate = None,None
     if image_description:
         # Extract the inner XML content
@@ -130,10 +289,37 @@ def load_image_data_moldev_concat(fname: str) -> tuple:
     # Raise an error if exposure information is not found
     if exposure_units is None or frate is None:
         raise ValueError(f"Exposure information not found in metadata for file {fname}.")
+    return frate, exposure_units
 
-    # Check and print a warning if exposure units are not in msec
-    if exposure_units.lower() not in ['msec', 'ms']:
-        logging.warning(f"Exposure units for file {fname} are '{exposure_units}', not 'msec'.")
+def probe_image(fname: str) -> dict:
+    """
+    Probes a concatenated Molecular Devices Tiff file by parsing only its header (IFDs);
+    no pixel data is read, so this takes milliseconds even for multi-GB files.
 
-    # Return the image data and the frame rate
-    return im, frate
\ No newline at end of file
+    Args:
+    fname (str): The file path of the Tiff file.
+
+    Returns:
+    dict: The image properties:
+          - frate: The frame rate extracted from the metadata.
+          - exposure_units: The exposure units in the metadata.
+          - shape: The shape of the image data.
+          - dtype: The dtype of the image data.
+          - nbytes: The size of the (uncompressed) image data in bytes.
+
+    Raises:
+    ValueError: If the exposure information is not found in the metadata.
+    """
+    with tifffile.TiffFile(fname) as tif:
+        series = tif.series[0]
+        shape, dtype = tuple(series.shape), series.dtype
+        image_description = tif.pages[0].tags.get('ImageDescription')
+        image_description = image_description.value if image_description else None
+    frate, exposure_units = extract_frate_concat(image_description, fname)
+    return {
+        'frate': frate,
+        'exposure_units': exposure_units,
+        'shape': shape,
+        'dtype': dtype,
+        'nbytes': int(np.prod(shape)) * dtype.itemsize
+    }
@@ -3,17 +3,24 @@
 ## batteries
 from __future__ import print_function
 import os
+import time
+import multiprocessing
 import logging
 import argparse
+from collections import namedtuple
 import tifffile
 ## 3rd party
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.ndimage import label, sum as ndi_sum
+from scipy.ndimage import gaussian_laplace
 from cellpose import models, io
 ## source
-from load_czi import load_image_data_czi
-from load_tiff import load_image_data_moldev_concat
+from image_source import ImageSource, write_caiman_memmap
+from load_tiff import tiff_compression_args, TIFF_COMPRESSIONS
+from frame_stats import FrameStats, clean_chunk
+from region_stats import region_stats, write_region_stats
+from tiles import tile_grid, stitch_tiles
+from model_store import read_checksums, verify_model
 
 # logging
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
@@ -27,26 +34,78 @@ desc = "Mask image"
 epi = """DESCRIPTION:
 Mask the image using the Cellpose model.
 If masking fails, the unmasking image is outputted.
+
+Multiple images can be provided, which are masked one after the other with the same (loaded once) Cellpose models.
+With --output-dir or multiple images, the outputs of each image are written to <output-dir>/<image basename>/.
 """
 parser = argparse.ArgumentParser(description=desc, epilog=epi,
                                  formatter_class=CustomFormatter)
-parser.add_argument('img_file', type=str,
-                    help='Directory path containing the image files')
+parser.add_argument('img_files', type=str, nargs='+',
+                    help='Image file(s)')
+parser.add_argument('--output-dir', type=str, default=None,
+                    help='Write the outputs of each image to a subdirectory of this directory. If not provided, a single image is written to the working directory')
 parser.add_argument('--file-type', type=str, default='zeiss',
                     help='Type of image file')
 parser.add_argument('--use-2d', action='store_true',
                     help='2d, so no masking')
 parser.add_argument('--min-object-size', type=int, default=500,
-                    help='Minimum size of objects in pixels for successful segmentation')
+                    help='Minimum size of objects in pixels for successful segmentation '
+                         '(the pixel area of each connected object; older versions summed the label values '
+                         'of the object, which overstated the sizes, so thresholds tuned on them may need lowering)')
 parser.add_argument('--max-segment-retries', type=int, default=3,
                     help='Maximum number of retries for segmentation if objects are below the threshold')
 parser.add_argument('--start-diameter', type=int, default=300,
                     help='Starting diameter for segmentation')
 parser.add_argument('--diameter-step', type=int, default=200,
                     help='Step to increase the diameter after each failed attempt')
-
+parser.add_argument('--diameter-search', type=str, default='estimate', choices=['estimate', 'linear'],
+                    help='Diameter search: estimate the diameter in one pass and bisect only if segmentation fails, or step linearly from --start-diameter by --diameter-step')
+parser.add_argument('--parallel-attempts', type=int, default=0,
+                    help='If >1, the diameter search (if the estimate fails) runs this many (model, diameter) attempts concurrently and stops at the first success')
+parser.add_argument('--segment-bin', type=int, default=1,
+                    help='Bin the min projection by this factor for segmentation (diameters and object sizes are scaled accordingly); the masks are upsampled to full resolution')
+parser.add_argument('--tile-size', type=int, default=0,
+                    help='If >0, segment the min projection in overlapping tiles of this size (pixels), which are stitched by IoU matching. For large fields of view')
+parser.add_argument('--tile-overlap', type=int, default=0,
+                    help='Min overlap between tiles (pixels). If 0, the segmentation diameter')
+parser.add_argument('--tile-processes', type=int, default=1,
+                    help='Number of processes segmenting the tiles')
+parser.add_argument('--caiman-memmap', action='store_true', default=False,
+                    help='Write the (no-)masked image as a CaImAn memmap file (*_d1_*_d2_*_d3_1_order_C_frames_*_.mmap) instead of a tiff file')
+parser.add_argument('--compression', type=str, default='none', choices=TIFF_COMPRESSIONS,
+                    help='Compression of the (no-)masked tiff file (ignored with --caiman-memmap)')
+parser.add_argument('--compression-level', type=int, default=None,
+                    help='Compression level. If not provided, the codec default is used')
+
+
+# Cellpose models, loaded once per model type
+CELLPOSE_MODELS = {}
+# Tiled segmentation settings (see `segment`)
+Tiling = namedtuple('Tiling', ['size', 'overlap', 'processes'])
+# Process pool of the tiled segmentation, created once and reused for all attempts and images
+TILE_POOL = None
 
 # functions
+def get_cellpose_model(model_type: str) -> models.Cellpose:
+    """
+    Gets a Cellpose model, loading it on first use and reusing it for all later images.
+    Args:
+        model_type: The Cellpose model type (e.g., 'nuclei' or 'cyto3').
+    Returns:
+        The Cellpose model.
+    """
+    if model_type not in CELLPOSE_MODELS:
+        logging.info(f"Loading the '{model_type}' Cellpose model...")
+        # check the weights against the model store checksums, if any (see download_cellpose_models.py)
+        store_dir = str(models.MODEL_DIR)
+        checksums = read_checksums(store_dir)
+        if checksums:
+            invalid = verify_model(store_dir, model_type, checksums)
+            if invalid:
+                raise RuntimeError(f"Invalid '{model_type}' weights in the model store {store_dir}: {', '.join(invalid)}")
+        CELLPOSE_MODELS[model_type] = models.Cellpose(gpu=False, model_type=model_type)
+    return CELLPOSE_MODELS[model_type]
+
 def segment_image(im_min: np.ndarray, model: models.Cellpose, max_diameter: int, start_diameter: int = 300, diameter_step: int = 200) -> tuple:
     """
     Segments the image using the provided model and adjusts the diameter if necessary.
@@ -81,7 +140,7 @@ def segment_image(im_min: np.ndarray, model: models.Cellpose, max_diameter: int,
             else:
                 if model == original_model:
                     logging.info("Switching to 'cyto3' model.")
-                    model = models.Cellpose(gpu=False, model_type="cyto3")
+                    model = get_cellpose_model("cyto3")
                     diameter = start_diameter
                     first_exceed = False
                 else:
@@ -94,9 +153,316 @@ def segment_image(im_min: np.ndarray, model: models.Cellpose, max_diameter: int,
     # failed to segment
     return None, False, diameter
 
-def mask_image(im_min: np.ndarray, min_object_size: int=500, max_segment_retries: int=3, start_diameter: int = 300, diameter_step: int = 200) -> np.ndarray:
+def blob_scale_diameter(im: np.ndarray, max_size: int=256, n_scales: int=16) -> float:
+    """
+    Estimates the characteristic object diameter of an image from its blob scale: 
+    the scale of the maximal scale-normalized Laplacian-of-Gaussian response of bright objects, 
+    computed on a downsampled copy of the image.
+    Args:
+        im: The (Y, X) image.
+        max_size: The image is downsampled so that its largest dimension is at most this size.
+        n_scales: The number of (log-spaced) scales tested.
+    Returns:
+        The estimated diameter, in pixels of the full-resolution image.
+    """
+    # downsample
+    factor = max(1, int(np.ceil(max(im.shape) / max_size)))
+    small = im[:im.shape[0] // factor * factor, :im.shape[1] // factor * factor].astype(np.float32)
+    small = small.reshape(small.shape[0] // factor, factor, small.shape[1] // factor, factor).mean(axis=(1, 3))
+    small = (small - small.mean()) / (small.std() + 1e-6)
+    # scale-normalized LoG responses of bright blobs (blob diameter = 2*sqrt(2)*sigma)
+    sigmas = np.geomspace(1, max(min(small.shape) / 4, 1.5), n_scales)
+    responses = [np.max(-sigma ** 2 * gaussian_laplace(small, sigma)) for sigma in sigmas]
+    return float(2 * np.sqrt(2) * sigmas[int(np.argmax(responses))] * factor)
+
+def estimate_diameter(im_min: np.ndarray, model: models.Cellpose) -> float:
+    """
+    Estimates the object diameter in one pass with the Cellpose size model,
+    falling back to the blob-scale estimate if the size model is not available or fails.
+    Args:
+        im_min: The minimum projection of the image data.
+        model: The Cellpose model.
+    Returns:
+        The estimated diameter, in pixels.
+    """
+    try:
+        diameter, _ = model.sz.eval(im_min, channels=[0, 0])
+        diameter = float(np.squeeze(diameter))
+        if np.isfinite(diameter) and diameter > 0:
+            logging.info(f"Size model diameter estimate: {diameter:.1f}")
+            return diameter
+        logging.warning(f"Invalid size model diameter estimate: {diameter}")
+    except Exception as e:
+        logging.warning(f"Size model diameter estimation failed: {e}")
+    diameter = blob_scale_diameter(im_min)
+    logging.info(f"Blob-scale diameter estimate: {diameter:.1f}")
+    return diameter
+
+def get_tile_pool(processes: int):
+    """
+    Gets the process pool of the tiled segmentation, creating it on first use.
+    Args:
+        processes: The number of worker processes.
+    Returns:
+        The process pool.
+    """
+    global TILE_POOL
+    if TILE_POOL is None:
+        threads = max(1, (os.cpu_count() or 1) // processes)
+        logging.info(f"Starting {processes} tile segmentation processes...")
+        # spawn (not fork) the workers, since torch is already initialized in this process
+        TILE_POOL = multiprocessing.get_context("spawn").Pool(processes, initializer=init_segment_worker, initargs=(threads,))
+    return TILE_POOL
+
+def close_tile_pool() -> None:
+    """
+    Closes the process pool of the tiled segmentation, if one is running.
+    """
+    global TILE_POOL
+    if TILE_POOL is not None:
+        TILE_POOL.close()
+        TILE_POOL.join()
+        TILE_POOL = None
+
+def segment_tile(task: tuple) -> np.ndarray:
+    """
+    Segments one tile (in a worker process of the tiled segmentation).
+    Args:
+        task: The (tile image, model_type, diameter) of the tile.
+    Returns:
+        The label masks of the tile.
+    """
+    im, model_type, diameter = task
+    masks, _, _, _ = get_cellpose_model(model_type).eval(im, diameter=diameter)
+    return masks
+
+def segment(im_min: np.ndarray, model_type: str, diameter: int, tiling: Tiling=None) -> np.ndarray:
+    """
+    Segments the image with a Cellpose model, either at once or, with tiling, in overlapping tiles
+    that are segmented in parallel and stitched by IoU matching (see `tiles.stitch_tiles`).
+    The tiles overlap by at least the diameter, so that objects on the seams are whole in a tile.
+    Args:
+        im_min: The minimum projection of the image data.
+        model_type: The Cellpose model type.
+        diameter: The diameter for segmentation.
+        tiling: The tiled segmentation settings. If None (or the image fits in a tile), the image is segmented at once.
+    Returns:
+        The label masks.
+    """
+    if tiling is None or tiling.size <= 0 or max(im_min.shape) <= tiling.size:
+        masks, _, _, _ = get_cellpose_model(model_type).eval(im_min, diameter=diameter)
+        return masks
+    overlap = tiling.overlap if tiling.overlap > 0 else diameter
+    if 2 * overlap >= tiling.size:
+        logging.warning(f"Tile overlap ({overlap}) is over half the tile size ({tiling.size}); segmenting the image at once")
+        masks, _, _, _ = get_cellpose_model(model_type).eval(im_min, diameter=diameter)
+        return masks
+    grid = tile_grid(im_min.shape, tiling.size, overlap)
+    tasks = [(im_min[y0:y1, x0:x1], model_type, diameter) for (y0, x0, y1, x1), _ in grid]
+    logging.info(f"Segmenting {len(tasks)} tiles of size {tiling.size} (overlap {overlap})...")
+    if tiling.processes > 1:
+        tile_masks = get_tile_pool(tiling.processes).map(segment_tile, tasks)
+    else:
+        tile_masks = [segment_tile(task) for task in tasks]
+    return stitch_tiles(im_min.shape, [(window, own, m) for (window, own), m in zip(grid, tile_masks)])
+
+def try_segment(im_min: np.ndarray, model_type: str, diameter: int, min_object_size: int, attempts: list,
+                tiling: Tiling=None) -> np.ndarray:
+    """
+    Runs one segmentation attempt and checks it with the `min_object_size` rule.
+    Args:
+        im_min: The minimum projection of the image data.
+        model_type: The Cellpose model type.
+        diameter: The diameter for segmentation.
+        min_object_size: The minimum object size for successful segmentation.
+        attempts: The list of attempts, which the attempt is appended to.
+        tiling: The tiled segmentation settings (see `segment`).
+    Returns:
+        The masks if successful, otherwise None.
+    """
+    t0 = time.time()
+    masks = segment(im_min, model_type, diameter, tiling)
+    object_sizes = region_stats(masks)['area']
+    success = bool(np.any(object_sizes >= min_object_size))
+    elapsed = time.time() - t0
+    attempts.append((model_type, diameter, len(object_sizes), success, elapsed))
+    logging.info(
+        f"Attempt #{len(attempts)}: model={model_type}, diameter={diameter}, objects={len(object_sizes)}, "
+        f"max size={object_sizes.max(initial=0)}, success={success} ({elapsed:.1f} sec)"
+    )
+    return masks if success else None
+
+def bisect_diameter(im_min: np.ndarray, model_type: str, lo: int, hi: int, min_object_size: int, 
+                    max_steps: int, attempts: list, tiling: Tiling=None) -> np.ndarray:
+    """
+    Searches for the smallest successful diameter in (lo, hi] by bisection, 
+    assuming that segmentation failed at `lo` and that larger diameters yield larger objects.
+    Args:
+        im_min: The minimum projection of the image data.
+        model_type: The Cellpose model type.
+        lo: The (failed) lower bound of the diameter.
+        hi: The upper bound of the diameter, which is tried first.
+        min_object_size: The minimum object size for successful segmentation.
+        max_steps: The maximum number of bisection steps after `hi` succeeds.
+        attempts: The list of attempts, which the attempts are appended to.
+        tiling: The tiled segmentation settings (see `segment`).
+    Returns:
+        The masks of the smallest successful diameter, or None if `hi` fails.
+    """
+    logging.info(f"Segmentation failed at diameter {lo}; searching up to {hi}...")
+    masks = try_segment(im_min, model_type, hi, min_object_size, attempts, tiling)
+    if masks is None:
+        return None
+    for _ in range(max_steps):
+        mid = (lo + hi) // 2
+        if mid <= lo:
+            break
+        mid_masks = try_segment(im_min, model_type, mid, min_object_size, attempts, tiling)
+        if mid_masks is not None:
+            hi, masks = mid, mid_masks
+        else:
+            lo = mid
+    return masks
+
+def init_segment_worker(threads: int) -> None:
+    """
+    Initializes a worker process of the speculative segmentation pool.
+    Args:
+        threads: The number of torch threads per worker, so the workers do not oversubscribe the cores.
+    """
+    import torch
+    torch.set_num_threads(threads)
+    logging.getLogger().setLevel(logging.WARNING)
+
+def segment_candidate(task: tuple) -> tuple:
+    """
+    Runs one (model, diameter) segmentation attempt in a worker process.
+    Args:
+        task: The (im_min, model_type, diameter, min_object_size) of the attempt.
+    Returns:
+        The attempt (model_type, diameter, number of objects, success, seconds) and the masks (None if unsuccessful).
+    """
+    im_min, model_type, diameter, min_object_size = task
+    attempts = []
+    masks = try_segment(im_min, model_type, diameter, min_object_size, attempts)
+    return attempts[0], masks
+
+def search_candidates(estimate: int, max_diameter: int, n_per_model: int, model_types: list) -> list:
+    """
+    Lists the (model, diameter) candidates of the speculative search, in order of preference:
+    the estimate and `n_per_model` diameters evenly spaced above it up to the max diameter, for each model.
+    Args:
+        estimate: The estimated diameter.
+        max_diameter: The maximum diameter.
+        n_per_model: The number of diameters per model.
+        model_types: The Cellpose model types, in order of preference.
+    Returns:
+        The (model_type, diameter) candidates.
+    """
+    diameters = np.unique(np.round(np.linspace(estimate, max_diameter, n_per_model + 1)).astype(int))
+    return [(model_type, int(d)) for model_type in model_types for d in diameters]
+
+def parallel_segment(im_min: np.ndarray, candidates: list, min_object_size: int, processes: int, attempts: list) -> np.ndarray:
+    """
+    Evaluates the (model, diameter) candidates concurrently in a process pool and returns the first successful masks.
+    The pool is terminated as soon as there is a winner, which cancels the outstanding attempts.
+    Args:
+        im_min: The minimum projection of the image data.
+        candidates: The (model_type, diameter) candidates.
+        min_object_size: The minimum object size for successful segmentation.
+        processes: The number of worker processes.
+        attempts: The list of attempts, which the completed attempts are appended to.
+    Returns:
+        The first successful masks, or None if all candidates fail.
+    """
+    processes = max(1, min(processes, len(candidates)))
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    logging.info(f"Speculatively segmenting {len(candidates)} (model, diameter) candidates with {processes} processes...")
+    tasks = [(im_min, model_type, diameter, min_object_size) for model_type, diameter in candidates]
+    # spawn (not fork) the workers, since torch is already initialized in this process
+    pool = multiprocessing.get_context("spawn").Pool(processes, initializer=init_segment_worker, initargs=(threads,))
+    try:
+        for attempt, masks in pool.imap_unordered(segment_candidate, tasks):
+            attempts.append(attempt)
+            model_type, diameter, n_objects, success, elapsed = attempt
+            logging.info(
+                f"Attempt #{len(attempts)}: model={model_type}, diameter={diameter}, objects={n_objects}, "
+                f"success={success} ({elapsed:.1f} sec)"
+            )
+            if masks is not None:
+                logging.info("Cancelling the outstanding attempts")
+                return masks
+    finally:
+        pool.terminate()
+        pool.join()
+    return None
+
+def mask_image(im_min: np.ndarray, min_object_size: int=500, max_segment_retries: int=3, start_diameter: int = 300, 
+               diameter_step: int = 200, diameter_search: str = "estimate", parallel_attempts: int = 0,
+               tiling: Tiling = None) -> np.ndarray:
     """
     Masks the image using the Cellpose model.
+    By default ("estimate"), the diameter is estimated in one pass (see `estimate_diameter`) and 
+    segmentation is attempted at the estimate. Only if that fails, the diameter is bisected between 
+    the estimate and the image height (`max_segment_retries` steps, after checking the image height itself),
+    first with the 'nuclei' and then with the 'cyto3' model. 
+    If `parallel_attempts` > 1, the search instead evaluates `parallel_attempts` (model, diameter) candidates
+    per model concurrently, and stops at the first success (see `parallel_segment`).
+    With "linear", the diameter is stepped linearly instead (see `mask_image_linear`).
+    With `tiling`, each segmentation attempt of the (sequential) search is run in parallel tiles (see `segment`).
+    Args:
+        im_min: The minimum projection of the image data.
+        min_object_size: The minimum object size to consider for successful segmentation.
+        max_segment_retries: The maximum number of retries (bisection steps) to attempt segmentation.
+        start_diameter: The starting diameter for the linear search.
+        diameter_step: The step to increase the diameter after each failed attempt of the linear search.
+        diameter_search: The diameter search: "estimate" or "linear".
+        parallel_attempts: If > 1, the number of concurrent segmentation attempts of the diameter search.
+        tiling: The tiled segmentation settings (see `segment`).
+    Returns:
+        masks: The masks to apply to the image data. Returns None if segmentation fails.
+    """
+    if diameter_search == "linear":
+        return mask_image_linear(im_min, min_object_size, max_segment_retries, start_diameter, diameter_step)
+
+    logging.info("Masking image...")
+    t0 = time.time()
+    max_diameter = im_min.shape[0]
+    attempts = []
+    masks = None
+    model_types = ["nuclei", "cyto3"]
+    for i, model_type in enumerate(model_types):
+        # estimate the diameter
+        t1 = time.time()
+        estimate = estimate_diameter(im_min, get_cellpose_model(model_type))
+        diameter = int(np.clip(round(estimate), 1, max_diameter))
+        logging.info(f"Diameter estimate ({model_type}): {diameter} ({time.time() - t1:.1f} sec)")
+
+        # segment at the estimated diameter
+        masks = try_segment(im_min, model_type, diameter, min_object_size, attempts, tiling)
+        if masks is None and parallel_attempts > 1:
+            # speculative search over the remaining (not yet attempted) models and diameters
+            candidates = search_candidates(diameter, max_diameter, parallel_attempts, model_types[i:])
+            candidates = [x for x in candidates if x != (model_type, diameter)]
+            masks = parallel_segment(im_min, candidates, min_object_size, parallel_attempts, attempts)
+            break
+        if masks is None and diameter < max_diameter:
+            masks = bisect_diameter(im_min, model_type, diameter, max_diameter, min_object_size, max_segment_retries, attempts, tiling)
+        if masks is not None:
+            break
+
+    # status
+    elapsed = time.time() - t0
+    if masks is None:
+        logging.error(f"Segmentation failed after {len(attempts)} attempts ({elapsed:.1f} sec). No objects met the threshold ({min_object_size}). Proceeding without creating mask.")
+        return None
+    model_type, diameter = [x[:2] for x in attempts if x[3]][-1]
+    logging.info(f"Successfully segmented objects larger than the threshold ({min_object_size}) with model={model_type}, diameter={diameter} after {len(attempts)} attempts ({elapsed:.1f} sec).")
+    return masks
+
+def mask_image_linear(im_min: np.ndarray, min_object_size: int=500, max_segment_retries: int=3, start_diameter: int = 300, diameter_step: int = 200) -> np.ndarray:
+    """
+    Masks the image using the Cellpose model, stepping the diameter linearly until segmentation succeeds.
     Args:
         im_min: The minimum projection of the image data.
         min_object_size: The minimum object size to consider for successful segmentation. Default is 1000.
@@ -109,8 +475,8 @@ def mask_image(im_min: np.ndarray, min_object_size: int=500, max_segment_retries
     """
     logging.info("Masking image...")
 
-    # Import the cellpose model
-    model = models.Cellpose(gpu=False, model_type="nuclei")
+    # Get the cellpose model
+    model = get_cellpose_model("nuclei")
 
     # Set the maximum diameter for segmentation
     max_diameter = im_min.shape[0]
@@ -128,7 +494,7 @@ def mask_image(im_min: np.ndarray, min_object_size: int=500, max_segment_retries
         return None
 
     # Detect object sizes
-    object_sizes = detect_object_sizes(masks)
+    object_sizes = region_stats(masks)['area'].tolist()
     logging.info(f"Object sizes detected: {object_sizes}")
 
     # Check if all objects are larger than the threshold
@@ -150,7 +516,7 @@ def mask_image(im_min: np.ndarray, min_object_size: int=500, max_segment_retries
             masks, success, final_diameter = segment_image(im_min, model, max_diameter, start_diameter=final_diameter)
             
             # Check if segmentation was successful by detecting object sizes
-            object_sizes = detect_object_sizes(masks)
+            object_sizes = region_stats(masks)['area'].tolist()
             logging.info(f"Object sizes detected: {object_sizes} for retry #{retry_count + 1}")
         else:
             break  # Exit if valid objects are detected
@@ -168,38 +534,82 @@ def mask_image(im_min: np.ndarray, min_object_size: int=500, max_segment_retries
     # Return the masks as a binary array
     return masks
 
-def create_minprojection(im: np.ndarray, img_file: str, file_type: str) -> np.ndarray:
+def bin_image(im: np.ndarray, k: int) -> np.ndarray:
     """
-    Create a min projection of the image series and save it as a tiff file.
+    Bins a (Y, X) image by averaging k x k blocks; trailing rows/columns that do not fill a block are dropped.
     Args:
-        im: The image data.
-        img_file: The path to the image file.
-        file_type: The type of file being processed.
+        im: The image.
+        k: The binning factor.
     Returns:
-        im_min: The min projection of the image series.
+        The (Y // k, X // k) binned image (the image itself if k is 1).
     """
-    # Grab the min projection of the image series
-    if file_type.lower() == "moldev":
-        im_min = np.min(im, axis=0)
-    else:
-        im_min = np.squeeze(np.min(im, axis=1))
+    if k <= 1:
+        return im
+    ny, nx = im.shape[0] // k, im.shape[1] // k
+    return im[:ny * k, :nx * k].reshape(ny, k, nx, k).mean(axis=(1, 3), dtype=np.float32)
+
+def upsample_masks(masks: np.ndarray, k: int, shape: tuple) -> np.ndarray:
+    """
+    Upsamples a label mask of a binned image back to full resolution (nearest neighbour),
+    extending the edge labels over any rows/columns dropped by binning.
+    Args:
+        masks: The (Y // k, X // k) label mask.
+        k: The binning factor.
+        shape: The (Y, X) full-resolution shape.
+    Returns:
+        The (Y, X) label mask.
+    """
+    up = np.repeat(np.repeat(masks, k, axis=0), k, axis=1)
+    pad = ((0, shape[0] - up.shape[0]), (0, shape[1] - up.shape[1]))
+    return np.pad(up, pad, mode='edge')
 
-    # Save the min projection image
-    base_fname = os.path.splitext(os.path.basename(img_file))[0]
-    tifffile.imwrite(f"{base_fname}_minprojection.tif", im_min)
-    # return the min projection
-    return im_min
+def create_projections(src: ImageSource, out_base: str) -> dict:
+    """
+    Create the min, max, mean and std projections of the image series in a single pass over the frames,
+    and save them as tiff files (`*_minprojection.tif`, `*_maxprojection.tif`, etc.), 
+    so later steps can read them instead of reloading the movie.
+    Args:
+        src: The image data (reduced chunk-by-chunk).
+        out_base: The base of the output file names (output directory and image basename).
+    Returns:
+        The (Y, X) projections, keyed by 'min', 'max', 'mean' and 'std'.
+    """
+    # Grab the projections of the image series
+    projections = src.projections()
+
+    # Save the projection images
+    for name, im in projections.items():
+        tifffile.imwrite(f"{out_base}_{name}projection.tif", im)
+    # return the projections
+    return projections
+
+def write_image(src: ImageSource, base: str, caiman_memmap: bool=False, tiff_args: dict=None) -> str:
+    """
+    Write the (T, Y, X) image data, streaming it chunk-by-chunk.
+    Args:
+        src: The image data.
+        base: The base of the output file name (path without extension).
+        caiman_memmap: If True, write a CaImAn memmap file instead of a tiff file.
+        tiff_args: Extra `TiffWriter.write` arguments, such as compression (see `tiff_compression_args`).
+    Returns:
+        The output file path.
+    """
+    if caiman_memmap:
+        return write_caiman_memmap(src, base)
+    outfile = base + ".tif"
+    with tifffile.TiffWriter(outfile, bigtiff=True) as tif:
+        tif.write(src.iter_frames(), shape=src.shape, dtype=src.dtype, **(tiff_args or {}))
+    return outfile
 
 def plot_mask(original_image: np.ndarray, masked_image: np.ndarray, mask: np.ndarray, 
-              file_type: str, save_path: str=None) -> None:
+              save_path: str=None) -> None:
     """
     Plots the original projection image, the masked image, and the mask side by side,
     and saves the figure if a save path is provided.
     Args:
         original_image: The original min projection image.
-        masked_image: The masked image.
+        masked_image: The (Y, X) masked image.
         mask: The mask image.
-        file_type: The type of file being processed.
         save_path: The path where the figure should be saved. Default is None.
     """
     # Change logging level
@@ -208,15 +618,11 @@ def plot_mask(original_image: np.ndarray, masked_image: np.ndarray, mask: np.nda
     # Plot the original and masked images side by side
     fig, axes = plt.subplots(1, 3, figsize=(18, 6))
 
-    if file_type == 'zeiss':
-        axes[1].imshow(np.squeeze(np.max(masked_image, axis=0)), cmap='gray')
-    else:
-        axes[1].imshow(masked_image, cmap='gray')
-    
     axes[0].imshow(original_image, cmap='gray')
     axes[0].set_title('Original Projection Image')
     axes[0].axis('off')
 
+    axes[1].imshow(masked_image, cmap='gray')
     axes[1].set_title('Masked Image')
     axes[1].axis('off')
 
@@ -228,187 +634,200 @@ def plot_mask(original_image: np.ndarray, masked_image: np.ndarray, mask: np.nda
     if save_path:
         fig.savefig(save_path, format='tiff')
     # plt.show()
+    plt.close(fig)
 
     # Status
     logging.getLogger().setLevel(logging.INFO)
     logging.info(f"Masked image plot saved to {save_path}")
 
-def format_masks(im: np.ndarray, im_min: np.ndarray, masks: np.ndarray, 
-                 img_file: str, file_type: str) -> None:
+def format_masks(src: ImageSource, im_min: np.ndarray, masks: np.ndarray, out_base: str,
+                 caiman_memmap: bool=False, tiff_args: dict=None) -> None:
     """
-    Formats the masks to apply to each time slice of the image, and saves the masked image and the masks to tiff files.
+    Formats the masks to apply to each time slice of the image, and saves the masked image and the masks to tiff files,
+    and the per-object statistics of the masks to a csv file.
     Args:
-        im: The original image data.
+        src: The (T, Y, X) image data.
         im_min: The minimum projection of the image data.
         masks: The masks to apply to the image data.
-        img_file: The path to the image file.
-        file_type: The type of file being processed.
+        out_base: The base of the output file names (output directory and image basename).
+        caiman_memmap: If True, the masked image is saved as a CaImAn memmap file instead of a tiff file.
+        tiff_args: Extra `TiffWriter.write` arguments for the masked tiff file (e.g., compression).
     """
-    # Get the base file name
-    base_fname = os.path.splitext(os.path.basename(args.img_file))[0]
-
     # Write masks to tiff file
-    tifffile.imwrite(f"{base_fname}_masks.tif", masks)
+    tifffile.imwrite(f"{out_base}_masks.tif", masks)
 
-    # Ensure mask is binary and broadcast the mask to apply it to each time slice
-    masked_im = im * masks.astype(bool)[np.newaxis, :, :]
-            
-    # Add an epsilon to avoid division by zero
-    epsilon = 10
-            
-    # Preprocess the input data to replace zeros and NaNs
-    masked_im = np.nan_to_num(masked_im, nan=epsilon, posinf=epsilon, neginf=epsilon)
-    masked_im[masked_im == 0] = epsilon
+    # Write the per-object statistics (area, bounding box, centroid, mean min projection intensity)
+    write_region_stats(region_stats(masks, im_min), f"{out_base}_mask-objects.csv")
 
-    # Validate and preprocess the masked data
-    logging.info("Validating masked image data...")
-    masked_im = validate_input_data(masked_im, f"{base_fname}_masked")
+    # Mask the image as it is streamed to the output file, chunk-by-chunk in the image dtype
+    keep = masks.astype(bool)
+    stats_in, stats_out = FrameStats(src.dtype), FrameStats(src.dtype)
+    masked_src = src.map_chunks(
+        lambda chunk: mask_chunk(chunk, keep, stats_in=stats_in, stats_out=stats_out)
+    )
 
     # Plot the original and masked images side by side
-    outfile = os.path.splitext(img_file)[0] + "_masked-plot.tif"
-    plot_mask(im_min, masked_im[0], masks, file_type=file_type, save_path=outfile)
+    outfile = f"{out_base}_masked-plot.tif"
+    plot_mask(im_min, mask_chunk(np.array(src[0]), keep), masks, save_path=outfile)
             
-    # Save the masked image to the temp file
-    outfile = os.path.splitext(img_file)[0] + "_masked.tif"
-    tifffile.imwrite(outfile, masked_im)
+    # Save the masked image, validating and preprocessing the masked data on the fly
+    logging.info("Validating masked image data...")
+    outfile = write_image(masked_src, f"{out_base}_masked", caiman_memmap, tiff_args)
+    log_validation(src.shape, src.dtype, stats_in, stats_out, f"{os.path.basename(out_base)}_masked")
     logging.info(f"Masked image saved to {outfile}")
 
-def detect_object_sizes(mask: np.ndarray) -> list:
+def mask_chunk(chunk: np.ndarray, mask: np.ndarray, epsilon: float=10, 
+               stats_in: FrameStats=None, stats_out: FrameStats=None) -> np.ndarray:
     """
-    Detects the sizes of objects in the given mask.
+    Masks a chunk of frames in place, in its dtype: pixels outside of the mask, zeros and NaN/inf values are set to
+    epsilon (to avoid division by zero), and the chunk is then validated: values below the float epsilon
+    are replaced (see `clean_chunk`), and the statistics before and after are accumulated (see `log_validation`).
     Args:
-        mask: Binary mask where objects are labeled as 1.
+        chunk: The writable (n, Y, X) or (Y, X) chunk of frames.
+        mask: The (Y, X) binary mask.
+        epsilon: The value of the masked pixels, zeros, and NaN/inf values.
+        stats_in: If provided, the statistics of the masked data are accumulated before validation.
+        stats_out: If provided, the statistics of the masked data are accumulated after validation.
     Returns:
-        A list of object sizes (number of pixels per object).
+        The masked chunk (the same array).
     """
-    if mask is None or mask.sum() == 0:
-        logging.warning("Mask is empty. No objects detected.")
-        return []
-
-    labeled_mask, num_features = label(mask)
-    object_sizes = [ndi_sum(mask, labeled_mask, index=i + 1) for i in range(num_features)]
-    return object_sizes
-
-def validate_input_data(Y: np.ndarray, fname: str, 
-                        epsilon: float = np.finfo(float).eps) -> np.ndarray:
+    chunk[..., ~mask] = 0
+    if chunk.dtype.kind == 'f':
+        np.nan_to_num(chunk, copy=False, nan=epsilon, posinf=epsilon, neginf=epsilon)
+    chunk[chunk == 0] = epsilon
+    if stats_in is not None:
+        stats_in.update(chunk)
+    clean_chunk(chunk, np.finfo(float).eps)
+    if stats_out is not None:
+        stats_out.update(chunk)
+    return chunk
+
+def log_validation(shape: tuple, dtype: np.dtype, stats_in: FrameStats, stats_out: FrameStats, 
+                   fname: str, epsilon: float = np.finfo(float).eps) -> None:
     """
-    Validates and preprocesses input data for further processing.
-    
+    Logs the statistics of the data before and after validation, and the fixes made.
     Args:
-        Y: Input data array
+        shape: The (T, Y, X) shape of the data
+        dtype: The dtype of the data
+        stats_in: The statistics of the data before validation
+        stats_out: The statistics of the data after validation
         fname: Filename for logging purposes
-        epsilon: Small value to replace zeros/invalid values. If None, calculated from data
-    
-    Returns:
-        Preprocessed numpy array with validated data
-        
-    Raises:
-        ValueError: If validation completely fails
+        epsilon: The min value of the validated data
     """
-    # Check for empty or invalid data
-    if Y is None or Y.size == 0:
-        logging.error(f"Empty or invalid data in {fname}")
-
-    # Calculate epsilon if not provided
-    if epsilon is None:
-        epsilon = np.finfo(Y.dtype).eps * 10
-
-    valid_mask = ~np.isnan(Y) & ~np.isinf(Y)
-    n_invalid = Y.size - np.sum(valid_mask)
-
     # Log basic statistics about input data
     logging.info("Input data statistics for debugging:")
-    logging.info(f"Shape: {Y.shape} ({Y.shape[0]} time points)")
-    logging.info(f"dtype: {Y.dtype}")
-    logging.info(f"Min: {np.min(Y)}")
-    logging.info(f"Max: {np.max(Y)}")
-    logging.info(f"Mean: {np.mean(Y)}")
-    logging.info(f"Median: {np.median(Y)}")
-    logging.info(f"Contains NaN: {np.any(np.isnan(Y))}")
-    logging.info(f"Contains inf: {np.any(np.isinf(Y))}")
-    logging.info(f"Contains zeros: {np.any(Y == 0)}")
-    
-    # Save original data statistics
-    orig_min = np.min(Y[valid_mask])
-    orig_max = np.max(Y[valid_mask])
-    
-    # Handle invalid values
-    if np.any(np.isnan(Y)) or np.any(np.isinf(Y)):
+    logging.info(f"Shape: {shape} ({shape[0]} time points)")
+    logging.info(f"dtype: {dtype}")
+    stats_in.log()
+
+    # Invalid values
+    if stats_in.n_nan > 0 or stats_in.n_inf > 0:
         logging.warning(f"Found NaN/inf values in {fname}, replacing with valid values")
-        Y = np.nan_to_num(Y, nan=epsilon, posinf=orig_max, neginf=orig_min)
     
-    # Handle zeros or very small values that could cause division issues
-    if np.any(Y < epsilon):
+    # Zeros or very small values that could cause division issues
+    if stats_in.min is not None and stats_in.min < epsilon:
         logging.warning(f"Found values smaller than {epsilon} in {fname}, replacing with epsilon")
-        Y[Y < epsilon] = epsilon
     
     # Verify the fixes worked
-    if np.any(np.isnan(Y)) or np.any(np.isinf(Y)):
+    if stats_out.n_nan > 0 or stats_out.n_inf > 0:
         logging.error(f"Failed to fix NaN/inf values in {fname}")
     
     # Log final statistics
     logging.info("Final data statistics after preprocessing:")
-    logging.info(f"Min: {np.min(Y)}")
-    logging.info(f"Max: {np.max(Y)}")
-    logging.info(f"Mean: {np.mean(Y)}")
-    
-    return Y
+    logging.info(f"Min: {stats_out.min}")
+    logging.info(f"Max: {stats_out.max}")
+    logging.info(f"Mean: {stats_out.mean}")
 
+def write_unmasked(src: ImageSource, out_base: str, caiman_memmap: bool=False, tiff_args: dict=None) -> None:
+    """
+    Writes the unmasked image, and empty masks and object statistics files, if masking is skipped or fails.
+    Args:
+        src: The (T, Y, X) image data.
+        out_base: The base of the output file names (output directory and image basename).
+        caiman_memmap: If True, the image is saved as a CaImAn memmap file instead of a tiff file.
+        tiff_args: Extra `TiffWriter.write` arguments for the tiff file (e.g., compression).
+    """
+    # masked image
+    outfile = write_image(src, f"{out_base}_no-masked", caiman_memmap, tiff_args)
+    logging.info(f"No-masked image saved to {outfile}")
+    # image masks
+    outfile = f"{out_base}_no-masks.tif"
+    open(outfile, "w").close()
+    logging.info(f"No-masks image saved to {outfile}")
+    # object statistics (no objects)
+    write_region_stats(region_stats(None), f"{out_base}_no-mask-objects.csv")
+
+def process_image(img_file: str, out_dir: str, args, tiff_args: dict=None) -> None:
+    """
+    Masks one image and writes its outputs.
+    Args:
+        img_file: The path to the image file.
+        out_dir: The output directory.
+        args: The command line arguments.
+        tiff_args: Extra `TiffWriter.write` arguments for the (no-)masked tiff file (e.g., compression).
+    """
+    logging.info(f"Processing image: {img_file}")
+    os.makedirs(out_dir, exist_ok=True)
+    out_base = os.path.join(out_dir, os.path.splitext(os.path.basename(img_file))[0])
 
-def main(args):
-    logging.info("Starting mask.py...")
-    # Set up the cellpose logger
-    logger = io.logger_setup()
-
-    # Load the image data
-    if args.file_type.lower() == "moldev":
-        # Extract the image data for Molecular Devices
-        im, frate = load_image_data_moldev_concat(args.img_file)
-    elif args.file_type.lower() == "zeiss":
-        # Extract the image data for Zeiss images
-        im, frate = load_image_data_czi(args.img_file)
-    else:
-        raise ValueError(f"File type not recognized: {args.file_type}")
+    # Load the image data, as a lazy (T, Y, X) view
+    src = ImageSource(img_file, args.file_type)
+    frate = src.frate
 
     # Write frame rate to a file
     logging.info(f"Frame rate: {frate}")
-    with open("frate.txt", "w") as outF:
+    with open(os.path.join(out_dir, "frate.txt"), "w") as outF:
         outF.write(f"FRATE={frate}")
     
-    # Create min projection
-    im_min = create_minprojection(im, args.img_file, args.file_type)
+    # Create the min/max/mean/std projections
+    im_min = create_projections(src, out_base)['min']
 
     # Save the image as a tif file, if no masking
     if args.use_2d:
         logging.info("2D image, skipping masking")
-        # masked image
-        outfile = os.path.splitext(args.img_file)[0] + "_no-masked.tif"
-        tifffile.imwrite(outfile, im)
-        logging.info(f"No-masked image saved to {outfile}")
-        # image masks
-        outfile = os.path.splitext(args.img_file)[0] + "_no-masks.tif"
-        open(outfile, "w").close()
-        logging.info(f"No-masks image saved to {outfile}")
-        exit(0)
-
-    # Mask the image
-    masks = mask_image(im_min, args.min_object_size, args.max_segment_retries, args.start_diameter, args.diameter_step)
+        write_unmasked(src, out_base, args.caiman_memmap, tiff_args)
+        return None
+
+    # Mask the image, optionally on a binned min projection (with all sizes scaled accordingly)
+    k = max(args.segment_bin, 1)
+    if k > 1:
+        logging.info(f"Segmenting the min projection binned by {k}")
+    tiling = Tiling(args.tile_size // k, args.tile_overlap // k, args.tile_processes) if args.tile_size > 0 else None
+    masks = mask_image(
+        bin_image(im_min, k), int(np.ceil(args.min_object_size / k ** 2)), args.max_segment_retries, 
+        max(args.start_diameter // k, 1), max(args.diameter_step // k, 1), args.diameter_search, args.parallel_attempts,
+        tiling
+    )
+    if masks is not None and k > 1:
+        masks = upsample_masks(masks, k, im_min.shape)
 
     # If segmentation/masking fails, write unmasked image
     if masks is None:
         logging.warning("Masking failed; writing the unmasked image")
-        # masked image
-        outfile = os.path.splitext(args.img_file)[0] + "_no-masked.tif"  
-        tifffile.imwrite(outfile, im)
-        logging.info(f"No-masked image saved to {outfile}")
-        # image masks
-        outfile = os.path.splitext(args.img_file)[0] + "_no-masks.tif"
-        open(outfile, "w").close()
-        logging.info(f"No-masks image saved to {outfile}")
-        exit(0)
+        write_unmasked(src, out_base, args.caiman_memmap, tiff_args)
+        return None
 
     # Format the masks
-    format_masks(im, im_min, masks, args.img_file, args.file_type)
+    format_masks(src, im_min, masks, out_base, args.caiman_memmap, tiff_args)
+
+def main(args):
+    logging.info("Starting mask.py...")
+    # Set up the cellpose logger
+    logger = io.logger_setup()
+
+    # Compression of the output tiff file
+    tiff_args = tiff_compression_args(args.compression, args.compression_level)
+
+    # Process the images in order; the Cellpose models are loaded once and reused for all images
+    per_image_dirs = args.output_dir is not None or len(args.img_files) > 1
+    try:
+        for img_file in args.img_files:
+            out_dir = "."
+            if per_image_dirs:
+                out_dir = os.path.join(args.output_dir or ".", os.path.splitext(os.path.basename(img_file))[0])
+            process_image(img_file, out_dir, args, tiff_args)
+    finally:
+        close_tile_pool()
     
 ## script main
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+# import
+## batteries
+import os
+import json
+import hashlib
+import logging
+
+# Cellpose model weights (segmentation and size models) per model type, as named by Cellpose
+MODEL_FILES = {
+    'nuclei': ['nucleitorch_0', 'size_nucleitorch_0.npy'],
+    'cyto3': ['cyto3', 'size_cyto3.npy'],
+}
+# Cellpose model download URL
+MODEL_URL = "https://www.cellpose.org/models"
+# Checksums of the model weights in the store
+CHECKSUMS_FILE = "checksums.json"
+
+
+# functions
+def sha256sum(path: str, block_size: int=1 << 20) -> str:
+    """
+    Computes the sha256 checksum of a file.
+    Args:
+        path: The file path.
+        block_size: The number of bytes read at once.
+    Returns:
+        The hex digest.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as inF:
+        for block in iter(lambda: inF.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def read_checksums(store_dir: str) -> dict:
+    """
+    Reads the checksums of the model weights in the store.
+    Args:
+        store_dir: The model store directory.
+    Returns:
+        The checksum of each weights file name (empty if there is no checksums file).
+    """
+    infile = os.path.join(store_dir, CHECKSUMS_FILE)
+    if not os.path.isfile(infile):
+        return {}
+    with open(infile) as inF:
+        return json.load(inF)
+
+def write_checksums(store_dir: str, checksums: dict) -> None:
+    """
+    Writes the checksums of the model weights in the store, replacing any previous file atomically.
+    Args:
+        store_dir: The model store directory.
+        checksums: The checksum of each weights file name.
+    """
+    outfile = os.path.join(store_dir, CHECKSUMS_FILE)
+    tmp_file = f"{outfile}.tmp{os.getpid()}"
+    with open(tmp_file, "w") as outF:
+        json.dump(checksums, outF, indent=2, sort_keys=True)
+    os.replace(tmp_file, outfile)
+
+def verify_model(store_dir: str, model_type: str, checksums: dict=None) -> list:
+    """
+    Checks the weights of a model in the store against their checksums.
+    Args:
+        store_dir: The model store directory.
+        model_type: The Cellpose model type.
+        checksums: The store checksums. If None, they are read from the store.
+    Returns:
+        The weights file names that are missing, have no checksum, or do not match their checksum.
+    """
+    if checksums is None:
+        checksums = read_checksums(store_dir)
+    invalid = []
+    for name in MODEL_FILES[model_type]:
+        path = os.path.join(store_dir, name)
+        if name not in checksums or not os.path.isfile(path) or sha256sum(path) != checksums[name]:
+            invalid.append(name)
+    return invalid
+
+def populate_store(store_dir: str, model_types: list) -> None:
+    """
+    Makes sure that the store holds valid weights of the models, downloading only the missing or corrupted files.
+    Once populated, the store is resolved offline. Weights already in the store without a checksum
+    (e.g., downloaded by Cellpose itself) are trusted and their checksum is recorded.
+    Args:
+        store_dir: The model store directory.
+        model_types: The Cellpose model types.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    checksums = read_checksums(store_dir)
+    for model_type in model_types:
+        for name in MODEL_FILES[model_type]:
+            path = os.path.join(store_dir, name)
+            if os.path.isfile(path):
+                checksum = sha256sum(path)
+                if name not in checksums:
+                    logging.info(f"  Recording the checksum of {name}")
+                    checksums[name] = checksum
+                if checksum == checksums[name]:
+                    continue
+                logging.warning(f"  Checksum mismatch for {name}; downloading it again")
+            download_weights(name, path)
+            checksums[name] = sha256sum(path)
+        logging.info(f"Model '{model_type}' is available in the store")
+    write_checksums(store_dir, checksums)
+
+def download_weights(name: str, path: str) -> None:
+    """
+    Downloads a Cellpose weights file, writing it atomically.
+    Args:
+        name: The weights file name.
+        path: The output file path.
+    """
+    from cellpose.utils import download_url_to_file
+    url = f"{MODEL_URL}/{name}"
+    logging.info(f"  Downloading {url}")
+    tmp_file = f"{path}.tmp{os.getpid()}"
+    try:
+        download_url_to_file(url, tmp_file, progress=False)
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
@@ -0,0 +1,107 @@
+# import
+## batteries
+import csv
+import logging
+## 3rd party
+import numpy as np
+from scipy.ndimage import label, find_objects
+
+# Columns of the object statistics table (bounding boxes are [y0, y1) x [x0, x1))
+REGION_STATS_COLUMNS = ['label', 'area', 'y0', 'x0', 'y1', 'x1', 'centroid_y', 'centroid_x', 'mean_intensity']
+FLOAT_COLUMNS = ['centroid_y', 'centroid_x', 'mean_intensity']
+
+
+# functions
+def region_stats(mask: np.ndarray, image: np.ndarray=None) -> dict:
+    """
+    Computes per-object statistics of a mask in one vectorized pass.
+    Objects are the connected components of the non-zero pixels of the mask.
+    Args:
+        mask: The (Y, X) mask (binary or labeled).
+        image: The (Y, X) image for the mean intensity of each object (NaN if not provided).
+    Returns:
+        A dict of per-object arrays with the REGION_STATS_COLUMNS keys.
+    """
+    if mask is None or not np.any(mask):
+        return {k: np.zeros(0, dtype=np.float64 if k in FLOAT_COLUMNS else np.int64) for k in REGION_STATS_COLUMNS}
+
+    # label the objects
+    labeled, n_objects = label(mask)
+    flat = labeled.ravel()
+
+    # area and centroid
+    area = np.bincount(flat, minlength=n_objects + 1)
+    yy, xx = np.indices(mask.shape)
+    centroid_y = np.bincount(flat, weights=yy.ravel(), minlength=n_objects + 1)[1:] / area[1:]
+    centroid_x = np.bincount(flat, weights=xx.ravel(), minlength=n_objects + 1)[1:] / area[1:]
+
+    # mean intensity
+    if image is not None:
+        weights = np.asarray(image, dtype=np.float64).ravel()
+        mean_intensity = np.bincount(flat, weights=weights, minlength=n_objects + 1)[1:] / area[1:]
+    else:
+        mean_intensity = np.full(n_objects, np.nan)
+
+    # bounding boxes
+    boxes = np.array([[s[0].start, s[1].start, s[0].stop, s[1].stop] for s in find_objects(labeled)], dtype=np.int64)
+
+    return {
+        'label': np.arange(1, n_objects + 1),
+        'area': area[1:],
+        'y0': boxes[:, 0],
+        'x0': boxes[:, 1],
+        'y1': boxes[:, 2],
+        'x1': boxes[:, 3],
+        'centroid_y': centroid_y,
+        'centroid_x': centroid_x,
+        'mean_intensity': mean_intensity,
+    }
+
+def write_region_stats(stats: dict, outfile: str) -> None:
+    """
+    Writes the object statistics to a csv file (a header-only file if there are no objects).
+    Args:
+        stats: The object statistics (see `region_stats`).
+        outfile: The output csv file path.
+    """
+    with open(outfile, "w", newline="") as outF:
+        writer = csv.writer(outF)
+        writer.writerow(REGION_STATS_COLUMNS)
+        for row in zip(*[stats[k] for k in REGION_STATS_COLUMNS]):
+            writer.writerow([round(float(x), 3) if isinstance(x, np.floating) else x for x in row])
+    logging.info(f"Object statistics saved to {outfile}")
+
+def read_region_stats(infile: str) -> dict:
+    """
+    Reads the object statistics written by `write_region_stats`.
+    Args:
+        infile: The csv file path.
+    Returns:
+        A dict of per-object arrays with the REGION_STATS_COLUMNS keys.
+    """
+    with open(infile, newline="") as inF:
+        rows = list(csv.DictReader(inF))
+    stats = {}
+    for k in REGION_STATS_COLUMNS:
+        dtype = np.float64 if k in FLOAT_COLUMNS else np.int64
+        stats[k] = np.array([float(row[k]) for row in rows], dtype=np.float64).astype(dtype)
+    return stats
+
+def objects_bbox(stats: dict, shape: tuple, margin: int=0) -> tuple:
+    """
+    Gets the bounding box of all objects, padded by a margin and clipped to the image.
+    Args:
+        stats: The object statistics (see `region_stats`).
+        shape: The (Y, X) image shape.
+        margin: The padding around the objects, in pixels.
+    Returns:
+        The (y0, x0, y1, x1) bounding box, or None if there are no objects.
+    """
+    if len(stats['label']) == 0:
+        return None
+    return (
+        int(max(stats['y0'].min() - margin, 0)),
+        int(max(stats['x0'].min() - margin, 0)),
+        int(min(stats['y1'].max() + margin, shape[0])),
+        int(min(stats['x1'].max() + margin, shape[1])),
+    )
@@ -16,7 +16,7 @@ import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from IPython.display import HTML
 ## package
-from load_tiff import load_image_data_moldev_concat
+from load_tiff import probe_image
 
 # logging
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
@@ -304,7 +304,7 @@ def create_movie(puff, sim_num: int, args: dict):
     logging.info(f'Movie saved as TIFF to {movie_file}')
 
     ## Check the metadata formatting
-    load_image_data_moldev_concat(movie_file)
+    probe_image(movie_file)
 
 def main(args) -> Tuple[np.ndarray, np.ndarray]:
     """
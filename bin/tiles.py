@@ -0,0 +1,120 @@
+# import
+## batteries
+import logging
+## 3rd party
+import numpy as np
+
+
+# functions
+def tile_starts(n: int, tile_size: int, overlap: int) -> list:
+    """
+    Gets the start positions of evenly spaced tiles along one axis, overlapping by at least `overlap`.
+    Args:
+        n: The axis length.
+        tile_size: The tile length.
+        overlap: The min overlap between neighbouring tiles.
+    Returns:
+        The tile start positions.
+    """
+    if n <= tile_size:
+        return [0]
+    n_tiles = int(np.ceil((n - overlap) / (tile_size - overlap)))
+    return [int(x) for x in np.round(np.linspace(0, n - tile_size, n_tiles))]
+
+def tile_grid(shape: tuple, tile_size: int, overlap: int) -> list:
+    """
+    Splits a (Y, X) image into overlapping tiles. Each tile has a window (the pixels it is computed on)
+    and an owned box (the pixels it contributes to the result): the overlap between neighbouring tiles is
+    split at its middle, so the owned boxes partition the image and each is at least `overlap // 2`
+    pixels away from the window edges (except at the image edges).
+    Args:
+        shape: The (Y, X) image shape.
+        tile_size: The tile side length.
+        overlap: The min overlap between neighbouring tiles.
+    Returns:
+        The tiles, as ((y0, x0, y1, x1) window, (y0, x0, y1, x1) owned box), in raster order.
+    """
+    axes = []
+    for n in shape[:2]:
+        starts = tile_starts(n, tile_size, overlap)
+        ends = [min(s + tile_size, n) for s in starts]
+        seams = [(ends[i] + starts[i + 1]) // 2 for i in range(len(starts) - 1)]
+        own = list(zip([0] + seams, seams + [n]))
+        axes.append([(s, e, o0, o1) for s, e, (o0, o1) in zip(starts, ends, own)])
+    return [
+        ((ys, xs, ye, xe), (yo0, xo0, yo1, xo1))
+        for ys, ye, yo0, yo1 in axes[0] for xs, xe, xo0, xo1 in axes[1]
+    ]
+
+def match_labels(tile_labels: np.ndarray, labels: np.ndarray, valid: np.ndarray, iou_threshold: float) -> dict:
+    """
+    Matches the labels of a tile to the labels already stitched in its window, by their IoU
+    over the already stitched pixels of the window.
+    Args:
+        tile_labels: The (h, w) labels of the tile.
+        labels: The (h, w) stitched labels in the tile window.
+        valid: The (h, w) pixels of the window that are already stitched.
+        iou_threshold: The min IoU of a match.
+    Returns:
+        The best matching stitched label of each matched tile label.
+    """
+    a = tile_labels[valid].astype(np.int64)
+    b = labels[valid].astype(np.int64)
+    both = (a > 0) & (b > 0)
+    if not np.any(both):
+        return {}
+    area_a = np.bincount(a)
+    area_b = np.bincount(b)
+    pairs, inter = np.unique(a[both] * (len(area_b)) + b[both], return_counts=True)
+    pa, pb = pairs // len(area_b), pairs % len(area_b)
+    iou = inter / (area_a[pa] + area_b[pb] - inter)
+    matches = {}
+    for i in np.argsort(-iou):
+        if iou[i] < iou_threshold:
+            break
+        if pa[i] not in matches:
+            matches[int(pa[i])] = int(pb[i])
+    return matches
+
+def stitch_tiles(shape: tuple, tiles: list, iou_threshold: float=0.5) -> np.ndarray:
+    """
+    Stitches the label images of overlapping tiles (see `tile_grid`) into one label image.
+    Each tile writes its owned box; tile labels that overlap a label of the previously stitched tiles
+    (IoU >= `iou_threshold` over the overlap) keep that label, so objects crossing a seam get a single label.
+    Args:
+        shape: The (Y, X) image shape.
+        tiles: The (window, owned box, tile labels) of each tile, in raster order.
+        iou_threshold: The min IoU for two labels to be the same object.
+    Returns:
+        The (Y, X) label image, with labels 1..N.
+    """
+    labels = np.zeros(shape[:2], dtype=np.int64)
+    stitched = np.zeros(shape[:2], dtype=bool)
+    next_label = 1
+    n_matched = 0
+    for (y0, x0, y1, x1), (oy0, ox0, oy1, ox1), tile_labels in tiles:
+        tile_labels = np.asarray(tile_labels)
+        # match the tile labels to the already stitched labels of the window
+        matches = match_labels(tile_labels, labels[y0:y1, x0:x1], stitched[y0:y1, x0:x1], iou_threshold)
+        n_matched += len(matches)
+        # relabel the tile: matched labels are kept, the others are new
+        lut = np.zeros(int(tile_labels.max(initial=0)) + 1, dtype=np.int64)
+        for label in np.unique(tile_labels):
+            if label == 0:
+                continue
+            if label in matches:
+                lut[label] = matches[label]
+            else:
+                lut[label] = next_label
+                next_label += 1
+        # write the owned box
+        own = (slice(oy0 - y0, oy1 - y0), slice(ox0 - x0, ox1 - x0))
+        labels[oy0:oy1, ox0:ox1] = lut[tile_labels[own]]
+        stitched[oy0:oy1, ox0:ox1] = True
+    logging.info(f"Stitched {len(tiles)} tiles ({n_matched} objects matched across seams)")
+    # sequential labels (labels of tile objects outside of their owned box are dropped)
+    values, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.reshape(labels.shape)
+    if values[0] != 0:
+        inverse += 1
+    return inverse.astype(np.int32)
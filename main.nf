@@ -31,7 +31,9 @@ workflow {
     CAIMAN_WF(
         MASK_WF.out.img_orig, 
         MASK_WF.out.img_masked,
-        MASK_WF.out.img_masks
+        MASK_WF.out.img_masks,
+        MASK_WF.out.img_objects,
+        MASK_WF.out.img_mean
     )
     
     // Summarize log files
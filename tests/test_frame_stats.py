@@ -0,0 +1,37 @@
+import numpy as np
+
+from frame_stats import FrameStats, clean_chunk
+
+EPS = np.finfo(float).eps
+
+
+def test_clean_chunk_integer_zeros_stay_zero():
+    # epsilon cast to an integer dtype is 0, so zeros are kept as is
+    chunk = np.array([[0, 1, 5], [0, 0, 65535]], dtype=np.uint16)
+    clean_chunk(chunk, EPS)
+    np.testing.assert_array_equal(chunk, [[0, 1, 5], [0, 0, 65535]])
+    assert chunk.dtype == np.uint16
+
+
+def test_clean_chunk_integer_negatives_become_zero():
+    chunk = np.array([-3, -1, 0, 2], dtype=np.int16)
+    clean_chunk(chunk, EPS)
+    np.testing.assert_array_equal(chunk, [0, 0, 0, 2])
+
+
+def test_clean_chunk_float():
+    chunk = np.array([np.nan, -1.0, 0.0, -np.inf, 3.5], dtype=np.float32)
+    clean_chunk(chunk, EPS)
+    np.testing.assert_array_equal(chunk, np.array([EPS, EPS, EPS, EPS, 3.5], dtype=np.float32))
+
+
+def test_frame_stats_exact_median_and_counts():
+    data = np.array([[0, 3, 3], [7, 0, 9]], dtype=np.uint16)
+    stats = FrameStats(data.dtype)
+    stats.update(data[:1])
+    stats.update(data[1:])
+    assert stats.count == 6
+    assert stats.n_zero == 2
+    assert stats.min == 0 and stats.max == 9
+    assert stats.median == np.median(data)
+    assert np.isclose(stats.mean, data.mean())
@@ -0,0 +1,52 @@
+import os
+import logging
+
+from image_index import index_images, group_images
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as outF:
+        outF.write("x")
+
+
+def test_group_images_symlinked_inputs_keep_given_paths(tmp_path):
+    # the image files and the input directory are symlinks, as when staged by Nextflow
+    data = tmp_path / "data"
+    touch(str(data / "A01_s1_FITC-file2.tif"))
+    touch(str(data / "A01_s1_FITC-file1.tif"))
+    touch(str(data / "plate" / "B02_s1_FITC.tif"))
+    staged = tmp_path / "work" / "input"
+    os.makedirs(str(staged))
+    os.symlink(str(data / "A01_s1_FITC-file2.tif"), str(staged / "A01_s1_FITC-file2.tif"))
+    os.symlink(str(data / "A01_s1_FITC-file1.tif"), str(staged / "A01_s1_FITC-file1.tif"))
+    os.makedirs(str(staged / "plate"))
+    os.symlink(str(data / "plate" / "B02_s1_FITC.tif"), str(staged / "plate" / "B02_s1_FITC.tif"))
+    link = tmp_path / "link"
+    os.symlink(str(staged), str(link))
+
+    input_dir = os.path.join(str(link), "")
+    file_groups = group_images(index_images(input_dir, ('.tif',)))
+    assert file_groups == {
+        'A01_s1_FITC': [input_dir + "A01_s1_FITC-file1.tif", input_dir + "A01_s1_FITC-file2.tif"],
+        'B02_s1_FITC': [os.path.join(input_dir, "plate", "B02_s1_FITC.tif")],
+    }
+
+
+def test_manifest_reused_across_staged_paths(tmp_path, caplog):
+    data = tmp_path / "data"
+    touch(str(data / "sub" / "C03_s1_FITC.tif"))
+    manifest = str(tmp_path / "index.json")
+    records = {}
+    caplog.set_level(logging.INFO)
+    for run in ("run1", "run2"):
+        os.makedirs(str(tmp_path / run))
+        staged = str(tmp_path / run / "input")
+        os.symlink(str(data), staged)
+        records[run] = index_images(staged, ('.tif',), manifest)
+    # the paths follow the staged input directory of each run
+    assert [r.path for r in records["run1"]] == [os.path.join(str(tmp_path), "run1", "input", "sub", "C03_s1_FITC.tif")]
+    assert [r.path for r in records["run2"]] == [os.path.join(str(tmp_path), "run2", "input", "sub", "C03_s1_FITC.tif")]
+    # and the manifest is keyed by the resolved directory, so the second run re-lists nothing
+    assert [r._replace(path=None) for r in records["run1"]] == [r._replace(path=None) for r in records["run2"]]
+    assert "Listed 0 of 2 directories" in caplog.text
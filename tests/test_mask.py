@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip("cellpose")
+from image_source import ImageSource
+from mask import format_masks, mask_chunk
+
+
+def test_mask_chunk_integer_zero_fill():
+    # unmasked pixels and zeros become epsilon (10); the other values are unchanged
+    chunk = np.array([[[0, 4], [7, 0]], [[3, 0], [0, 65535]]], dtype=np.uint16)
+    mask = np.array([[True, True], [False, True]])
+    mask_chunk(chunk, mask)
+    np.testing.assert_array_equal(chunk, [[[10, 4], [10, 10]], [[3, 10], [10, 65535]]])
+    assert chunk.dtype == np.uint16
+
+
+def test_mask_chunk_integer_negatives_become_zero():
+    chunk = np.array([[-5, 0], [2, -1]], dtype=np.int16)
+    mask = np.ones((2, 2), dtype=bool)
+    mask_chunk(chunk, mask)
+    np.testing.assert_array_equal(chunk, [[0, 10], [2, 0]])
+
+
+def test_format_masks_integer_zero_fill(tmp_path):
+    rng = np.random.default_rng(0)
+    im = rng.integers(0, 3, size=(5, 16, 16)).astype(np.uint16)
+    masks = np.zeros((16, 16), dtype=np.int32)
+    masks[4:10, 4:10] = 1
+    out_base = str(tmp_path / "img")
+    format_masks(ImageSource.from_array(im, 1.0), im.min(axis=0), masks, out_base)
+
+    masked = tifffile.imread(f"{out_base}_masked.tif")
+    assert masked.dtype == np.uint16
+    expected = np.where(masks.astype(bool), im, 0)
+    expected[expected == 0] = 10
+    np.testing.assert_array_equal(masked, expected)
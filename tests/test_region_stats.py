@@ -0,0 +1,38 @@
+import numpy as np
+
+from region_stats import region_stats
+
+
+def test_region_stats_area_is_pixel_count():
+    # cellpose-style labeled mask: the size of an object is its pixel count, not the sum of its label values
+    mask = np.zeros((6, 8), dtype=np.uint16)
+    mask[0:2, 0:3] = 1
+    mask[4:6, 4:8] = 7
+    stats = region_stats(mask)
+    np.testing.assert_array_equal(stats['label'], [1, 2])
+    np.testing.assert_array_equal(stats['area'], [6, 8])
+
+
+def test_region_stats_touching_labels_are_one_object():
+    # objects are the connected components of the non-zero pixels, so touching labels are merged
+    mask = np.zeros((4, 4), dtype=np.uint16)
+    mask[0:2, 0:2] = 1
+    mask[0:2, 2:4] = 2
+    stats = region_stats(mask)
+    np.testing.assert_array_equal(stats['area'], [8])
+    np.testing.assert_array_equal([stats['y0'], stats['x0'], stats['y1'], stats['x1']], [[0], [0], [2], [4]])
+
+
+def test_region_stats_centroid_and_intensity():
+    mask = np.zeros((3, 3), dtype=bool)
+    mask[1, 0:3] = True
+    image = np.arange(9, dtype=np.float32).reshape(3, 3)
+    stats = region_stats(mask, image)
+    np.testing.assert_allclose([stats['centroid_y'][0], stats['centroid_x'][0]], [1.0, 1.0])
+    np.testing.assert_allclose(stats['mean_intensity'], [4.0])
+
+
+def test_region_stats_empty_mask():
+    stats = region_stats(np.zeros((3, 3), dtype=np.uint16))
+    assert all(len(v) == 0 for v in stats.values())
+    assert region_stats(None)['area'].dtype == np.int64
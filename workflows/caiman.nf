@@ -1,20 +1,50 @@
+include { wellFile } from './mask.nf'
+
 workflow CAIMAN_WF {
     take:
     ch_img_orig
     ch_img_masked
     ch_img_masks
+    ch_img_objects
+    ch_img_mean
 
     main:
-    // Run CAIMAN
-    CAIMAN(ch_img_masked, ch_img_masks, ch_img_orig)
+    // per-well inputs, keyed by the masked image base name
+    ch_img = ch_img_masked
+        .merge(ch_img_masks, ch_img_orig, ch_img_objects, ch_img_mean)
+        .map{ img_basename, frate, img_masked, img_masks, img_orig, img_objects, img_mean ->
+            tuple(maskedBaseName(img_masked), img_basename, frate, img_masked, img_masks, img_orig, img_objects, img_mean)
+        }
+
+    // Run CAIMAN, on batches of wells (one worker pool per batch)
+    ch_batches = ch_img
+        .buffer(size: params.caiman_batch_size.toInteger(), remainder: true)
+        .map{ batch -> tuple(batch.collect{ it[0] }, batch.collect{ it[2] }, batch.collect{ it[3] }, batch.collect{ it[6] }) }
+    CAIMAN(ch_batches)
+
+    // split the per-well output directories into per-well channels
+    // (wells without CNMF estimates, e.g., due to NaN values in the movie, are dropped)
+    ch_wells = CAIMAN.out.wells.flatten()
+        .filter{ well -> file("${well}/*_cnm-A.npy") }
+        .map{ well -> tuple(well.name, well) }
+        .join(ch_img)
+        .multiMap{ masked_name, well, img_basename, frate, img_masked, img_masks, img_orig, img_objects, img_mean ->
+            img_masked: tuple(img_basename, frate, img_masked)
+            img_masks: img_masks
+            img_orig: img_orig
+            img_mean: img_mean
+            cnm_A: wellFile(well, "*_cnm-A.npy")
+            cnm_idx: wellFile(well, "*_cnm-idx.npy")
+        }
 
     // run calc_dff_f0
     CALC_DFF_F0(
-        CAIMAN.out.img_masked,
-        CAIMAN.out.img_masks,
-        CAIMAN.out.img_orig,
-        CAIMAN.out.cnm_A, 
-        CAIMAN.out.cnm_idx
+        ch_wells.img_masked,
+        ch_wells.img_masks,
+        ch_wells.img_orig,
+        ch_wells.img_mean,
+        ch_wells.cnm_A, 
+        ch_wells.cnm_idx
     )
 
     emit:
@@ -27,6 +57,11 @@ def saveAsBase(filename){
     return filename.split("/")[-1]
 }
 
+// Base name of the masked image, without any CaImAn memmap suffix
+def maskedBaseName(img_masked){
+    return img_masked.baseName.replaceAll(/_d1_\d+_d2_\d+_d3_\d+_order_[CF]_frames_\d+_$/, "")
+}
+
 // Calculate dF/F0
 process CALC_DFF_F0 {
     publishDir file(params.output_dir) / "caiman_calc-dff-f0", mode: "copy", overwrite: true, saveAs: { filename -> saveAsBase(filename) }
@@ -37,6 +72,7 @@ process CALC_DFF_F0 {
     tuple val(img_basename), path(frate), path(img_masked)
     path img_masks
     path img_orig
+    path img_mean
     path cnm_A
     path cnm_idx
     
@@ -47,26 +83,29 @@ process CALC_DFF_F0 {
     path "output/*_f-dat.npy",                      emit: f_dat, optional: true
     path "output/*_dff-dat.npy",                    emit: dff_dat, optional: true
     path "output/*_df-f0-graph.png",                emit: df_f0_graph, optional: true
-    path "${img_masked.baseName}_calc-diff-f0.log", emit: log
+    path "*_calc-diff-f0.log",                      emit: log
 
     script:
+    def masked_name = maskedBaseName(img_masked)
     """
     calc_dff_f0.py \\
       --file-type ${params.file_type} \\
       --p_th ${params.p_th} \\
       --f_baseline_perc ${params.f_baseline_perc} \\
       --win_sz ${params.win_sz} \\
+      --mean-projection $img_mean \\
       $cnm_A \\
       $cnm_idx \\
       $img_orig \\
       $img_masks \\
-      2>&1 | tee ${img_masked.baseName}_calc-diff-f0.log
+      2>&1 | tee ${masked_name}_calc-diff-f0.log
     """
     
     stub:
+    def masked_name = maskedBaseName(img_masked)
     """
     mkdir -p output
-    touch output/blank.txt ${img_masked.baseName}_calc-diff-f0.log
+    touch output/blank.txt ${masked_name}_calc-diff-f0.log
     """
 }
 
@@ -94,58 +133,73 @@ process CAIMAN {
     errorStrategy { task.attempt <= maxRetries ? 'retry' : 'ignore' }
 
     input:
-    tuple val(img_basename), path(frate), path(img_masked)
-    path img_masks
-    path img_orig
+    tuple val(masked_names), path(frates, stageAs: "frate*.txt"), path(img_masked), path(img_objects)
 
     output:
-    tuple val(img_basename), path(frate), path(img_masked), emit: img_masked
-    path img_masks,                                         emit: img_masks
-    path img_orig,                                          emit: img_orig
-    path "caiman_output/*_cnm-A.npy",                       emit: cnm_A
-    path "caiman_output/*_cnm-C.npy",                       emit: cnm_C
-    path "caiman_output/*_cnm-S.npy",                       emit: cnm_S
-    path "caiman_output/*_cnm-idx.npy",                     emit: cnm_idx
-    path "caiman_output/*_cn-filter.npy",                   emit: cn_filter
-    path "caiman_output/*_pnr-filter.npy",                  emit: pnr_filter
-    path "caiman_output/*_correlation-pnr.png",             emit: corr_pnr
-    path "caiman_output/*_histogram-pnr-cn-filter.png",     emit: histo_pnr
-    path "caiman_output/*_cnm-traces.png",                  emit: traces, optional: true
-    path "caiman_output/*_cnm-denoised-traces.png",         emit: dn_traces, optional: true
-    path "${img_masked.baseName}_caiman.log",               emit: log
+    path "caiman_output/*", type: "dir",                      emit: wells       // per-well outputs
+    path "caiman_output/*/*_cnm-{A,C,S,idx}.npy",             emit: cnm, optional: true  // CNMF estimates
+    path "caiman_output/*/*_{cn,pnr}-filter.npy",             emit: filters, optional: true  // correlation and peak-to-noise ratio images
+    path "caiman_output/*/*_correlation-pnr.png",             emit: corr_pnr, optional: true
+    path "caiman_output/*/*_histogram-pnr-cn-filter.png",     emit: histo_pnr, optional: true
+    path "caiman_output/*/*_cnm-traces.png",                  emit: traces, optional: true
+    path "caiman_output/*/*_cnm-denoised-traces.png",         emit: dn_traces, optional: true
+    path "caiman_output/*/*_caiman.log",                      emit: log         // per-well logs
+    path "${masked_names[0]}_caiman-batch.log",               emit: batch_log
 
     script:
+    def frate_list = frates instanceof Collection ? frates : [frates]
+    def img_list = img_masked instanceof Collection ? img_masked : [img_masked]
+    def inputs = [frate_list, img_list].transpose().flatten().join(" ")
+    def crop_str = params.caiman_crop_to_objects == true ? "--objects_file ${img_objects}" : ""
+    def checkpoint_str = params.caiman_checkpoint_dir ? "--checkpoint_dir ${params.caiman_checkpoint_dir}" : ""
+    def memory_str = task.memory ? "--memory_limit ${task.memory.toGiga()}" : ""
     """
     # set the input paths
     export CAIMAN_DATA=caiman_data
     rm -rf \$CAIMAN_DATA && mkdir -p \${CAIMAN_DATA}/temp
-    cp $img_masked \${CAIMAN_DATA}/temp/
+    # a CaImAn memmap (from MASK) is loaded in place
+    for IMG in ${img_masked}; do
+      if [[ "\$IMG" != *.mmap ]]; then
+        cp \$IMG \${CAIMAN_DATA}/temp/
+      fi
+    done
 
     # run the caiman process
-    caiman_run.py -p $task.cpus \\
-      --decay_time $params.decay_time \\
-      --gSig $params.gSig \\
-      --rf $params.rf \\
-      --min_SNR $params.min_SNR \\
-      --r_values_min $params.r_values_min \\
-      --tsub $params.tsub \\
-      --ssub $params.ssub \\
-      --min_corr $params.min_corr \\
-      --min_pnr $params.min_pnr \\
-      --ring_size_factor $params.ring_size_factor \\
-      $frate $img_masked \\
-      2>&1 | tee ${img_masked.baseName}_caiman.log
+    caiman_run.py -p $task.cpus \
+      --decay_time $params.decay_time \
+      --gSig $params.gSig \
+      --rf $params.rf \
+      --min_SNR $params.min_SNR \
+      --r_values_min $params.r_values_min \
+      --tsub $params.tsub \
+      --ssub $params.ssub \
+      --min_corr $params.min_corr \
+      --min_pnr $params.min_pnr \
+      --ring_size_factor $params.ring_size_factor \
+      --per_image_dirs \
+      ${crop_str} ${checkpoint_str} ${memory_str} \
+      ${inputs} \
+      2>&1 | tee ${masked_names[0]}_caiman-batch.log
     """
 
     stub:
+    def wells = masked_names.collect{ "caiman_output/${it}" }.join(" ")
     """
-    mkdir -p caiman_output
-    touch caiman_output/${img_masked.baseName}_cnm_A.npy \\
-      caiman_output/${img_masked.baseName}_cnm_idx.npy \\
-      caiman_output/${img_masked.baseName}_correlation-pnr.png \\
-      caiman_output/${img_masked.baseName}_histogram-pnr-cn-filter.png \\
-      caiman_output/${img_masked.baseName}_cnm-traces.png \\
-      caiman_output/${img_masked.baseName}_cnm-denoised-traces.png \\
-      ${img_masked.baseName}_caiman.log
+    for WELL in ${wells}; do
+      NAME=\$(basename \$WELL)
+      mkdir -p \$WELL
+      touch \$WELL/\${NAME}_cnm-A.npy \
+        \$WELL/\${NAME}_cnm-C.npy \
+        \$WELL/\${NAME}_cnm-S.npy \
+        \$WELL/\${NAME}_cnm-idx.npy \
+        \$WELL/\${NAME}_cn-filter.npy \
+        \$WELL/\${NAME}_pnr-filter.npy \
+        \$WELL/\${NAME}_correlation-pnr.png \
+        \$WELL/\${NAME}_histogram-pnr-cn-filter.png \
+        \$WELL/\${NAME}_cnm-traces.png \
+        \$WELL/\${NAME}_cnm-denoised-traces.png \
+        \$WELL/\${NAME}_caiman.log
+    done
+    touch ${masked_names[0]}_caiman-batch.log
     """
 }
@@ -51,7 +51,7 @@ workflow INPUT_WF {
 process MOLDEV_CONCAT {
     publishDir file(params.output_dir) / "concatenated", mode: "copy", overwrite: true
     label "cellpose_env"
-    label "process_medium_mem"
+    label "process_low"
 
     input:
     tuple val(baseName), path(imagePaths)
@@ -61,8 +61,11 @@ process MOLDEV_CONCAT {
     path "${baseName}_moldev-cat.log",    emit: log
 
     script:
+    def cache_str = params.concat_cache_dir == null ? "" : "--cache-dir ${params.concat_cache_dir} --cache-max-gb ${params.concat_cache_max_gb}"
     """
-    concatenate_moldev_files.py \\
+    concatenate_moldev_files.py ${cache_str} \\
+      --threads ${task.cpus} \\
+      --compression ${params.intermediate_compression} \\
       --output output/${baseName}_full.tif \\
       $imagePaths \\
       2>&1 | tee ${baseName}_moldev-cat.log
@@ -88,8 +91,9 @@ process FORMAT_INPUT{
     script:
     def test_image_names = params.test_image_names == null ? "" : "--test-image-names \"${params.test_image_names}\""
     def test_image_count = params.test_image_count == 0 ? "" : "--test-image-count ${params.test_image_count}"
+    def manifest = params.input_manifest == null ? "" : "--manifest ${params.input_manifest}"
     """
-    format_input.py $test_image_names $test_image_count \\
+    format_input.py $test_image_names $test_image_count $manifest \\
       --file-type $params.file_type \\
       $input_dir \\
       2>&1 | tee format_input.log
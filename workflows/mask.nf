@@ -4,22 +4,54 @@ workflow MASK_WF {
     use_2d 
 
     main:
-    // download cellpose models
+    // download cellpose models (once per machine, if params.cellpose_model_dir is set)
     ch_models = DOWNLOAD_CELLPOSE_MODELS()
-    // mask each image
-    ch_img_mask = MASK(ch_img, ch_models.collect(), use_2d)
+    // mask the images in batches of params.mask_batch_size, so the models are loaded once per batch
+    ch_batches = ch_img
+        .buffer(size: params.mask_batch_size.toInteger(), remainder: true)
+        .map{ batch -> tuple(batch.collect{ it[0] }, batch.collect{ it[1] }) }
+    ch_img_mask = MASK(ch_batches, ch_models.first(), use_2d)
+
+    // split the per-image output directories into per-image channels
+    ch_wells = ch_img_mask.wells.flatten()
+        .map{ well -> tuple(well.name, well) }
+        .join(ch_img)
+        .multiMap{ img_basename, well, img_file ->
+            masked: tuple(img_basename, file("${well}/frate.txt"), wellFile(well, "*masked{.tif,_d1_*.mmap}"))
+            masks: wellFile(well, "*masks.tif")
+            objects: wellFile(well, "*mask-objects.csv")
+            mean_proj: wellFile(well, "*meanprojection.tif")
+            img_orig: img_file
+        }
     
     emit:
-    img_orig = ch_img_mask.img_orig // original images
-    img_masked = ch_img_mask.masked // masked images
-    img_masks = ch_img_mask.masks   // image masks
+    img_orig = ch_wells.img_orig     // original images
+    img_masked = ch_wells.masked     // masked images
+    img_masks = ch_wells.masks       // image masks
+    img_objects = ch_wells.objects   // mask object statistics
+    img_mean = ch_wells.mean_proj    // mean projections
     mask_log = ch_img_mask.log       // log files
 }
 
-// Select/format the output files
+// Get the single file matching a glob pattern in a per-image output directory
+def wellFile(well, pattern) {
+    def files = file("${well}/${pattern}")
+    if (files == null) {
+        error "No file matching '${pattern}' in ${well}"
+    }
+    if (files instanceof List) {
+        if (files.size() != 1) {
+            error "Expected one file matching '${pattern}' in ${well}, found ${files.size()}"
+        }
+        return files[0]
+    }
+    return files
+}
+
+// Select/format the output files (per-image outputs are published without their directory)
 def saveAsMask(filename) {
-    if (filename.endsWith('_masks.tif') || filename.endsWith('_full_minprojection.tif') || filename.endsWith('_masked.tif') || filename.endsWith('.log')){
-        return filename
+    if (filename.endsWith('_masks.tif') || filename.endsWith('_full_minprojection.tif') || filename.endsWith('_masked.tif') || filename.endsWith('_mask-objects.csv') || filename.endsWith('.log')){
+        return filename.split("/")[-1]
     } 
     return null
 }
@@ -31,45 +63,62 @@ process MASK {
     label "process_medium_mem"
 
     input:
-    tuple val(img_basename), path(img_file)
-    path "models/*"
+    tuple val(img_basenames), path(img_files)
+    path "models"
     each use_2d
 
     output:
-    tuple val(img_basename), path("frate.txt"), path("*masked.tif"),  emit: masked    // masked image
-    path img_file,                                emit: img_orig       // original image
-    path "*masks.tif",                            emit: masks          // image masks
-    path "*minprojection.tif",                    emit: minprojection  // minprojection image
-    path "*masked-plot.tif",                      emit: masked_plot, optional: true  
-    path "${img_basename}_mask.log",              emit: log  
+    path "mask_output/*", type: "dir",                       emit: wells          // per-image outputs: frate.txt, masked image (tiff or CaImAn memmap), masks
+    path "mask_output/*/*minprojection.tif",                 emit: minprojection  // minprojection images
+    path "mask_output/*/*{max,mean,std}projection.tif",      emit: projections    // max, mean, and std projection images
+    path "mask_output/*/*{masks,masked}.tif",                emit: published, optional: true  // masks and masked tiff images (for publishing)
+    path "mask_output/*/*mask-objects.csv",                  emit: objects        // mask object statistics
+    path "mask_output/*/*masked-plot.tif",                   emit: masked_plot, optional: true  
+    path "${img_basenames[0]}_mask.log",                     emit: log  
 
     script:
     def use_2d_str = use_2d == true ? "--use-2d" : ""
+    def caiman_memmap_str = params.caiman_memmap == true ? "--caiman-memmap" : ""
     """
     # set local models path
     export CELLPOSE_LOCAL_MODELS_PATH=models
     # run cellpose
-    mask.py --file-type ${params.file_type} ${use_2d_str} \\
+    mask.py --file-type ${params.file_type} ${use_2d_str} ${caiman_memmap_str} \\
             --min-object-size ${params.min_object_size} \\
             --max-segment-retries ${params.max_segment_retries} \\
             --start-diameter ${params.start_diameter} \\
             --diameter-step ${params.diameter_step} \\
-            ${img_file} \\
-            2>&1 | tee ${img_basename}_mask.log
+            --diameter-search ${params.diameter_search} \\
+            --parallel-attempts ${params.mask_parallel_attempts} \\
+            --segment-bin ${params.segment_bin} \\
+            --tile-size ${params.segment_tile_size} \\
+            --tile-processes ${params.segment_tile_processes} \\
+            --compression ${params.intermediate_compression} \\
+            --output-dir mask_output \\
+            ${img_files} \\
+            2>&1 | tee ${img_basenames[0]}_mask.log
     """
 
     stub:
+    def wells = img_basenames.collect{ "mask_output/${it}" }.join(" ")
     """
-    touch frate.txt image_masked.tif image_masks.tif ${img_basename}_mask.log image_full_minprojection.tif
+    for WELL in ${wells}; do
+      mkdir -p \$WELL
+      touch \$WELL/frate.txt \$WELL/image_masked.tif \$WELL/image_masks.tif \$WELL/image_full_minprojection.tif \$WELL/image_mask-objects.csv
+      touch \$WELL/image_full_maxprojection.tif \$WELL/image_full_meanprojection.tif \$WELL/image_full_stdprojection.tif
+    done
+    touch ${img_basenames[0]}_mask.log
     """
 }
 
-// Download cellpose models
+// Download cellpose models to a checksummed model store, 
+// which is persistent (and the process skipped once populated) if params.cellpose_model_dir is set
 process DOWNLOAD_CELLPOSE_MODELS {
+    storeDir params.cellpose_model_dir
     label "cellpose_env"
 
     output:
-    path "models/*"
+    path "models", type: "dir"
 
     script:
     """
@@ -82,6 +131,6 @@ process DOWNLOAD_CELLPOSE_MODELS {
     stub:
     """
     mkdir -p models
-    touch models/blank.txt
+    touch models/checksums.json
     """
 }
\ No newline at end of file